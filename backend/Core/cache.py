@@ -0,0 +1,160 @@
+'''
+Cache of dashboard query results, keyed on the endpoint and the normalized filters.
+
+Entries are tagged with the version of the dataset they were computed from. publish_dataframes
+bumps the version whenever router.dataframes changes, which drops every cached result, so
+results computed from older dataframes are never served again.
+'''
+from collections import OrderedDict
+from Utils.dataframeprocessor import normalize_date
+import hashlib
+import threading
+import uuid
+
+# Most results kept at once, across all endpoints
+MAX_CACHED_RESULTS = 256
+
+
+def normalize_filters(filters, fields=None):
+    """
+    JSON-able form of a filters model in which equivalent requests are equal: account order and
+    case, security case, P&L type case and date formats don't matter. Only the fields in fields
+    are kept when it is given, so filters a query doesn't read don't tell requests apart.
+    """
+    values = filters.model_dump(include=fields)
+    if 'accounts' in values:
+        values['accounts'] = sorted({account.upper() for account in values['accounts']})
+    if 'security' in values:
+        values['security'] = values['security'].upper()
+    if 'securities' in values:
+        values['securities'] = [security.upper() for security in values['securities']]
+    if 'pnl_type' in values:
+        values['pnl_type'] = values['pnl_type'].lower()
+    if 'pnl_types' in values:
+        values['pnl_types'] = [pnl_type.lower() for pnl_type in values['pnl_types']]
+    for field in ('start_date', 'end_date'):
+        if field not in values:
+            continue
+        try:
+            values[field] = normalize_date(values[field])
+        except Exception:
+            # Leave invalid dates as they are, the query itself reports the error
+            pass
+    return values
+
+
+class InFlight:
+    """A computation in progress that other requests for the same key can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.body = None
+
+
+class ResultCache:
+    """
+    Thread-safe LRU of response bodies that also coalesces identical in-flight queries.
+    The sync route handlers run in FastAPI's threadpool, so every access to the entries,
+    the in-flight computations and the counters holds the lock.
+    """
+
+    def __init__(self, max_entries=MAX_CACHED_RESULTS):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # ETags from another server process must never match, even at the same version number
+        self.instance = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.not_modified = 0
+        self.coalesced = 0
+        self.in_flight = {}
+
+    def key(self, endpoint, filters, fields=None):
+        return (self.version, endpoint, repr(normalize_filters(filters, fields)))
+
+    def etag(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        return f'"{self.instance}-{key[0]}-{digest}"'
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached body for key, or the body returned by compute(). Concurrent calls for
+        the same key share a single computation: the first caller computes while the others wait
+        for its result. Only successful (status 200) bodies are kept.
+        """
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return body
+
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = InFlight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            # The computation raised instead of returning a body, let this request try on its own
+            return flight.body if flight.body is not None else compute()
+
+        try:
+            flight.body = compute()
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+                if flight.body is not None and flight.body["status"] == 200:
+                    self.store(key, flight.body)
+            flight.done.set()
+
+        return flight.body
+
+    def store(self, key, body):
+        """Add an entry, evicting the least recently used ones. Must be called holding the lock."""
+        # Results computed while a new dataset was being published are not worth keeping
+        if key[0] != self.version:
+            return
+        self.entries[key] = body
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def record_not_modified(self):
+        with self.lock:
+            self.not_modified += 1
+
+    def new_version(self):
+        """Invalidate every cached result, called whenever the dataframes are replaced"""
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"version": self.version,
+                    "entries": len(self.entries),
+                    "max_entries": self.max_entries,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "not_modified": self.not_modified,
+                    "coalesced": self.coalesced,
+                    "in_flight": len(self.in_flight),
+                    "hit_rate": self.hits / lookups if lookups else None}
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value covers etag"""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return etag in tags or f"W/{etag}" in tags
@@ -1,20 +1,18 @@
 from Utils.db import get_db
 import Core.models as Model
 import Utils.dataframeprocessor as dfprocessor
+from Utils.aggregatecube import AggregateCube
+from Utils.sqlqueries import SqlQueries
 from pandas import DataFrame
 import numpy as np
 
-def get_topdown_bottomup_securities(filters: Model.Filters, dataframe: DataFrame):
+def get_topdown_bottomup_securities(filters: Model.Filters, cube: AggregateCube):
     try:
 
-        top_down = dfprocessor.get_top_down(dataframe=dataframe,
-                                accounts=filters.accounts,
-                                end_date=filters.end_date)
-        bottom_up = dfprocessor.get_bottom_up(dataframe=dataframe,
-                                accounts=filters.accounts,
-                                end_date=filters.end_date)
-
-        return {'top_down': top_down, 'bottom_up': bottom_up}
+        return cube.get_top_bottom(pnl_type=filters.pnl_type,
+                                   accounts=filters.accounts,
+                                   end_date=filters.end_date,
+                                   limit=filters.limit)
 
     except Exception as e:
         print(f"Error when retrieving top-down and bottom-up data: {e}")
@@ -22,23 +20,27 @@ def get_topdown_bottomup_securities(filters: Model.Filters, dataframe: DataFrame
 
 def get_available_tickers(dataframe: DataFrame):
     try:
-        tickers = dfprocessor.get_available_securities(dataframe)
-        return tickers.to_list()
+        if isinstance(dataframe, SqlQueries):
+            return dataframe.get_available_securities()
+        tickers = dfprocessor.get_security_columns(dataframe)
+        return list(tickers)
     except Exception as e:
         print(f"Error when retrieving tickers: {e}")
         raise e
 
 def get_available_accounts(dataframe: DataFrame):
     try:
+        if isinstance(dataframe, SqlQueries):
+            return dataframe.get_available_accounts()
         accounts = dfprocessor.get_available_accounts(dataframe)
         return accounts.tolist()
     except Exception as e:
         print(f"Error when retrieving tickers: {e}")
         raise e
 
-def get_graph_data(dataframe: DataFrame, filters: Model.Filters):
+def get_graph_data(cube: AggregateCube, filters: Model.Filters):
     try:
-        results = dfprocessor.get_security_values(dataframe=dataframe,
+        results = cube.get_security_values(pnl_type=filters.pnl_type,
                                                 security=filters.security.upper(), 
                                                 accounts = [account.upper() for account in filters.accounts],
                                                 start_date = filters.start_date, 
@@ -48,15 +50,36 @@ def get_graph_data(dataframe: DataFrame, filters: Model.Filters):
         print(f"Error when retrieving graph data for {filters.security}: {e}")
         raise e
 
-def get_card_data(dataframe: DataFrame, filters: Model.Filters):
+def get_batch_graph_data(cube: AggregateCube, filters: Model.GraphBatchFilters):
+    try:
+        results = cube.get_security_series(pnl_types=filters.pnl_types,
+                                           securities=filters.securities,
+                                           accounts=filters.accounts,
+                                           start_date=filters.start_date,
+                                           end_date=filters.end_date)
+        return results
+    except Exception as e:
+        print(f"Error when retrieving graph data for {filters.securities}: {e}")
+        raise e
+
+def get_card_data(cube: AggregateCube, filters: Model.Filters):
     try:
-        data = {
-            "total_gains": dfprocessor.get_total_gains(dataframe, end_date=filters.end_date, accounts=filters.accounts),
-            "realized_gains": dfprocessor.get_realized_gains(dataframe, end_date=filters.end_date, accounts=filters.accounts),
-            "unrealized_gains": dfprocessor.get_unrealized_gains(dataframe, end_date=filters.end_date, accounts=filters.accounts),
-            "interest": dfprocessor.get_interest(dataframe, end_date=filters.end_date, accounts=filters.accounts),
-            "dividends": dfprocessor.get_dividends(dataframe, end_date=filters.end_date, accounts=filters.accounts) }
+        data = cube.get_card_values(accounts=filters.accounts, end_date=filters.end_date)
         return data
     except Exception as e:
         print(f"Error when retrieving card data for {filters.accounts} on {filters.end_date}: {e}")
         raise e
+
+def get_dashboard_data(cube: AggregateCube, filters: Model.DashboardFilters):
+    try:
+        data = cube.get_dashboard(sections=list(dict.fromkeys(filters.sections)),
+                                  pnl_type=filters.pnl_type,
+                                  accounts=filters.accounts,
+                                  start_date=filters.start_date,
+                                  end_date=filters.end_date,
+                                  security=filters.security,
+                                  limit=filters.limit)
+        return data
+    except Exception as e:
+        print(f"Error when retrieving dashboard data for {filters.accounts} on {filters.end_date}: {e}")
+        raise e
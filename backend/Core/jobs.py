@@ -0,0 +1,195 @@
+'''
+Background jobs for database refreshes, so /database/refresh returns immediately
+instead of holding the event loop for the whole ingest.
+
+Job records are kept in a file next to the snapshot, shared by every worker process serving from
+it (python main.py --workers N), so any worker can report on a job and hand it to duplicate
+refresh requests, whichever worker runs it.
+'''
+from contextlib import contextmanager
+from Utils.AddNewStatement import add_data, IngestProgress
+from Utils.snapshot import SNAPSHOT_DIR
+from Core.workers import fcntl, refresh_lock
+import asyncio
+import json
+import os
+import time
+import uuid
+
+# Finished jobs kept around so clients can still poll their status
+MAX_FINISHED_JOBS = 20
+
+JOBS_FILE = 'refresh_jobs.json'
+JOBS_LOCK_FILE = 'refresh_jobs.lock'
+
+# How often a running job writes its progress to the jobs file
+JOB_SYNC_SECONDS = 1.0
+
+# An active job whose record hasn't been written for this long belongs to a process that exited
+STALE_JOB_SECONDS = 30.0
+
+
+class IngestJob:
+
+    def __init__(self, filepath):
+        self.id = uuid.uuid4().hex
+        self.filepath = filepath
+        self.status = 'pending'
+        self.progress = IngestProgress()
+        self.started = time.time()
+        self.finished = None
+        self.task = None
+
+    def is_active(self):
+        return self.status in ('pending', 'running')
+
+    def to_dict(self):
+        finished = self.finished if self.finished is not None else time.time()
+        return {"job_id": self.id,
+                "status": self.status,
+                "elapsed_seconds": finished - self.started,
+                **self.progress.to_dict()}
+
+
+class JobStore:
+    """
+    {job id: {"updated": time, "job": IngestJob.to_dict()}} in a JSON file in directory. Every
+    access holds an exclusive lock for the few milliseconds it takes to read and write the file.
+    """
+
+    def __init__(self, directory=SNAPSHOT_DIR):
+        self.directory = directory
+
+    @contextmanager
+    def records(self):
+        """The job records, written back when the block exits without an error"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, JOBS_LOCK_FILE), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+            path = os.path.join(self.directory, JOBS_FILE)
+            try:
+                with open(path) as f:
+                    records = json.load(f)
+            except (OSError, ValueError):
+                records = {}
+
+            yield records
+
+            temporary = f'{path}.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(records, f)
+            os.replace(temporary, path)
+
+    def save(self, job: IngestJob):
+        with self.records() as records:
+            records[job.id] = {"updated": time.time(), "job": job.to_dict()}
+
+
+def is_abandoned(record):
+    return (record["job"]["status"] in ('pending', 'running')
+            and time.time() - record["updated"] > STALE_JOB_SECONDS)
+
+
+def abandon(record):
+    """Mark the record of a job whose process exited before it finished as failed"""
+    record["job"]["status"] = 'failed'
+    record["job"]["error"] = "The worker process running the refresh exited before it finished"
+
+
+def remove_finished_records(records):
+    finished = [job_id for job_id, record in records.items()
+                if record["job"]["status"] not in ('pending', 'running')]
+    for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+        del records[job_id]
+
+
+class IngestJobRunner:
+    """
+    Runs add_data as a background task. Only one ingest runs at a time: refresh requests made
+    while a job is active, in this worker process or another one, are handed that job instead of
+    starting a duplicate. Jobs are also run under refresh_lock, so ingests never overlap.
+
+    on_complete is awaited with the StatementColumns returned by add_data once the
+    ingest finishes, even if it failed part-way, since those statements are in the database.
+    """
+
+    def __init__(self, on_complete, store=None):
+        self.on_complete = on_complete
+        self.store = store if store is not None else JobStore()
+        # Jobs run by this process, whose progress is more current than their records
+        self.jobs = {}
+
+    def submit(self, filepath="trades"):
+        """Start a refresh job and return (job, True), or (active job, False) if one is active, as dicts"""
+        job = IngestJob(filepath)
+        with self.store.records() as records:
+            for record in records.values():
+                if is_abandoned(record):
+                    abandon(record)
+                elif record["job"]["status"] in ('pending', 'running'):
+                    active = self.jobs.get(record["job"]["job_id"])
+                    return (active.to_dict() if active is not None else record["job"]), False
+
+            records[job.id] = {"updated": time.time(), "job": job.to_dict()}
+            remove_finished_records(records)
+
+        self.jobs[job.id] = job
+        self.remove_finished_jobs()
+        job.task = asyncio.create_task(self.run(job))
+        return job.to_dict(), True
+
+    def get(self, job_id):
+        """Status of a job run by any worker process, as a dict, or None if there is no such job"""
+        if job_id in self.jobs:
+            return self.jobs[job_id].to_dict()
+
+        with self.store.records() as records:
+            record = records.get(job_id)
+            if record is None:
+                return None
+            if is_abandoned(record):
+                abandon(record)
+            return record["job"]
+
+    async def sync(self, job: IngestJob):
+        """Keep the job's record current while it runs, which also shows it is still alive"""
+        while True:
+            await asyncio.sleep(JOB_SYNC_SECONDS)
+            try:
+                self.store.save(job)
+            except Exception as e:
+                print(f"Something went wrong while saving the progress of refresh job {job.id}: {e}")
+
+    async def run(self, job: IngestJob):
+        job.status = 'running'
+        sync = asyncio.create_task(self.sync(job))
+        try:
+            # Another worker process may be refreshing already
+            job.progress.start_stage('wait_for_other_refresh')
+            async with refresh_lock():
+                new_statements = await add_data(job.filepath, job.progress)
+
+                job.progress.start_stage('update_dataframes')
+                await self.on_complete(new_statements)
+                job.progress.finish_stage()
+
+            job.status = 'failed' if job.progress.error else 'completed'
+        except Exception as e:
+            print(f"Error while running refresh job {job.id}: {e}")
+            job.progress.error = str(e)
+            job.progress.finish_stage()
+            job.status = 'failed'
+        finally:
+            job.finished = time.time()
+            sync.cancel()
+            try:
+                self.store.save(job)
+            except Exception as e:
+                print(f"Something went wrong while saving refresh job {job.id}: {e}")
+
+    def remove_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if not job.is_active()]
+        for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
@@ -1,9 +1,9 @@
 '''
 Pydantic models for input validation. Primarily used with FastAPI routes in server.py
 '''
-from typing import List
+from typing import List, Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 
 class Account(BaseModel):
     id: str
@@ -27,4 +27,44 @@ class Filters(BaseModel):
     security: str
     start_date: str
     end_date: str
-    pnl_type: str
\ No newline at end of file
+    pnl_type: str
+    # Only return this many securities at each end of the top-down/bottom-up lists
+    limit: Optional[int] = Field(default=None, ge=1)
+
+    # Accounts and securities are stored upper case and P&L types lower case
+    @field_validator('accounts')
+    @classmethod
+    def upper_accounts(cls, accounts):
+        return [account.upper() for account in accounts]
+
+    @field_validator('security')
+    @classmethod
+    def upper_security(cls, security):
+        return security.upper()
+
+    @field_validator('pnl_type')
+    @classmethod
+    def lower_pnl_type(cls, pnl_type):
+        return pnl_type.lower()
+
+class GraphBatchFilters(BaseModel):
+    accounts: List[str]
+    securities: List[str]
+    start_date: str
+    end_date: str
+    pnl_types: List[str]
+
+    @field_validator('accounts', 'securities')
+    @classmethod
+    def upper_names(cls, names):
+        return [name.upper() for name in names]
+
+    @field_validator('pnl_types')
+    @classmethod
+    def lower_pnl_types(cls, pnl_types):
+        return [pnl_type.lower() for pnl_type in pnl_types]
+
+class DashboardFilters(Filters):
+    # Sections of the dashboard to compute, named after the endpoints that serve them one at a time
+    sections: List[Literal['card_data', 'graph_data', 'top_down_bottom_up']] = Field(
+        default=['card_data', 'graph_data', 'top_down_bottom_up'], min_length=1)
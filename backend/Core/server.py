@@ -1,10 +1,44 @@
 import Core.models as Models
-from fastapi import APIRouter
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import ORJSONResponse
+from Core.cache import ResultCache, etag_matches
+from Core.jobs import IngestJobRunner
+from Core.workers import SnapshotWatcher
 from Core.handlers import ( get_topdown_bottomup_securities, get_available_tickers,
-                            get_available_accounts, get_graph_data, get_card_data)
-from Utils.AddNewStatement import add_data
+                            get_available_accounts, get_graph_data, get_batch_graph_data, get_card_data,
+                            get_dashboard_data)
+from Utils.DataframeLoader import append_dataframes, build_dataframes, fetch_statement_columns
+from Utils.snapshot import write_snapshot
+from Utils.sqlqueries import SqlQueries, sql_dataframes
+from Utils.db import get_database_signature
+import asyncio
 
-router = APIRouter(prefix="/api")
+# Responses are serialized with orjson, which handles the long numeric lists of the graph
+# endpoints much faster than the standard library encoder and writes NaN as null
+router = APIRouter(prefix="/api", default_response_class=ORJSONResponse)
+
+result_cache = ResultCache()
+
+def cached_result(endpoint, filters, request: Request, compute, fields=None):
+    """
+    Serve a query from result_cache, computing and caching it on a miss. Results are keyed on
+    the filters in fields, the ones the query reads, or on all of them. Identical requests
+    arriving while it is being computed wait for that result instead of computing it again.
+    Successful results carry an ETag, and a request whose If-None-Match matches it gets an
+    empty 304 without the result being looked up or computed. Failed queries are never cached.
+    """
+    key = result_cache.key(endpoint, filters, fields)
+    etag = result_cache.etag(key)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        result_cache.record_not_modified()
+        return Response(status_code=304, headers={"ETag": etag})
+
+    body = result_cache.get_or_compute(key, compute)
+    if body["status"] != 200:
+        return ORJSONResponse(body)
+
+    # Returned as a response so FastAPI hands the body straight to orjson without re-encoding it
+    return ORJSONResponse(body, headers={"ETag": etag})
 
 @router.get("/accounts")
 def get_accounts():
@@ -27,41 +61,142 @@ def get_tickers():
         return {"status":500 , "message": f"Error retrieving available tickers: {e}", "data": None}
 
 @router.post("/card-data")
-def get_cards(filters: Models.Filters):
-    try:
-        data = get_card_data(router.dataframes["total"], filters) # any of the dataframes will do here
-        return {"status": 200, 
-                "message": "card data retrieved successfully",
-                "data": data}
-    except Exception as e:
-        return {"status":500 , "message": f"Error retrieving card data: {e}", "data": None}
+def get_cards(filters: Models.Filters, request: Request):
+    def compute():
+        try:
+            data = get_card_data(router.dataframes["cube"], filters)
+            return {"status": 200, 
+                    "message": "card data retrieved successfully",
+                    "data": data}
+        except Exception as e:
+            return {"status":500 , "message": f"Error retrieving card data: {e}", "data": None}
+
+    return cached_result("/card-data", filters, request, compute, fields={'accounts', 'end_date'})
 
 @router.post("/graph-data")
-def get_totals(filters: Models.Filters):
-    try:
-        data = get_graph_data(router.dataframes[filters.pnl_type], filters)
-        return {"status": 200, 
-                "message": "graph data retrieved successfully",
-                "data": data}
-    except Exception as e:
-        return {"status":500 , "message": f"Error retrieving {filters.pnl_type} graph data: {e}", "data": None}
+def get_totals(filters: Models.Filters, request: Request):
+    def compute():
+        try:
+            data = get_graph_data(router.dataframes["cube"], filters)
+            return {"status": 200, 
+                    "message": "graph data retrieved successfully",
+                    "data": data}
+        except Exception as e:
+            return {"status":500 , "message": f"Error retrieving {filters.pnl_type} graph data: {e}", "data": None}
+
+    return cached_result("/graph-data", filters, request, compute,
+                         fields={'accounts', 'security', 'start_date', 'end_date', 'pnl_type'})
+
+@router.post("/graph-data/batch")
+def get_batch_totals(filters: Models.GraphBatchFilters, request: Request):
+    def compute():
+        try:
+            data = get_batch_graph_data(router.dataframes["cube"], filters)
+            return {"status": 200,
+                    "message": "graph data retrieved successfully",
+                    "data": data}
+        except Exception as e:
+            return {"status":500 , "message": f"Error retrieving {filters.pnl_types} graph data: {e}", "data": None}
+
+    return cached_result("/graph-data/batch", filters, request, compute)
 
 @router.post("/top-down-bottom-up")
-def get_top_down_stocks(filters: Models.Filters):
-    try:
-        top_bottom_stocks = get_topdown_bottomup_securities(filters, router.dataframes[filters.pnl_type])
-        return {"status": 200, 
-                "message": "Top-down and Bottom-up securities data retrieved successfully", 
-                "data": top_bottom_stocks}
-    except Exception as e:
-        return {"status":500 , "message": f"Error retrieving top-down and bottom-up securities data: {e}", "data": None}
+def get_top_down_stocks(filters: Models.Filters, request: Request):
+    def compute():
+        try:
+            top_bottom_stocks = get_topdown_bottomup_securities(filters, router.dataframes["cube"])
+            return {"status": 200, 
+                    "message": "Top-down and Bottom-up securities data retrieved successfully", 
+                    "data": top_bottom_stocks}
+        except Exception as e:
+            return {"status":500 , "message": f"Error retrieving top-down and bottom-up securities data: {e}", "data": None}
+
+    return cached_result("/top-down-bottom-up", filters, request, compute,
+                         fields={'accounts', 'end_date', 'pnl_type', 'limit'})
+
+@router.post("/dashboard")
+def get_dashboard(filters: Models.DashboardFilters, request: Request):
+    def compute():
+        try:
+            data = get_dashboard_data(router.dataframes["cube"], filters)
+            if len(data["errors"]) == len(set(filters.sections)):
+                return {"status":500 , "message": f"Error retrieving dashboard data: {data['errors']}", "data": data}
+            return {"status": 200,
+                    "message": "dashboard data retrieved successfully",
+                    "data": data}
+        except Exception as e:
+            return {"status":500 , "message": f"Error retrieving dashboard data: {e}", "data": None}
+
+    return cached_result("/dashboard", filters, request, compute)
+
+def publish_dataframes(dataframes):
+    """
+    Swap in a new set of dataframes. Handlers look up router.dataframes once per request,
+    so they see either the old set or the new one, never a mix of both.
+    """
+    router.dataframes = dataframes
+    # Bumped after the swap, so results cached under the new version never come from the old set
+    result_cache.new_version()
+
+async def apply_new_statements(new_statements):
+    """
+    Append statements added by a refresh job to the live dataframes and refresh the snapshot.
+    When the job replaced stored statements, the dataframes are rebuilt from the database instead.
+    """
+    if not new_statements.length:
+        return
+
+    # The SQL backend already reads them from the database, only its cached symbols are stale
+    if isinstance(router.dataframes['cube'], SqlQueries):
+        publish_dataframes(sql_dataframes(router.dataframes['cube'].path))
+        return
+
+    # With several workers, another one may have refreshed since this worker last loaded the
+    # snapshot, so catch up first and append onto its statements rather than overwrite them
+    if snapshot_watcher.is_running():
+        await snapshot_watcher.check()
+
+    loop = asyncio.get_running_loop()
+    if new_statements.replaced:
+        columns = await fetch_statement_columns()
+        dataframes = await loop.run_in_executor(None, build_dataframes, columns)
+    else:
+        dataframes = await loop.run_in_executor(None, append_dataframes, router.dataframes, new_statements)
+    publish_dataframes(dataframes)
+
+    signature = await get_database_signature()
+    await loop.run_in_executor(None, write_snapshot, dataframes, signature)
+    if snapshot_watcher.is_running():
+        snapshot_watcher.mark_written()
+
+ingest_jobs = IngestJobRunner(on_complete=apply_new_statements)
+
+# Only started in multi-worker mode, see Core/workers.py
+snapshot_watcher = SnapshotWatcher(on_change=publish_dataframes)
+
+@router.get("/cache/stats")
+def get_cache_stats():
+    return {"status": 200,
+            "message": "cache statistics retrieved successfully",
+            "data": result_cache.stats()}
 
 # DB
 @router.get("/database/refresh")
 async def refresh_database():
     try:
-        await add_data()
-        return {"status": 200, 
-                "message": "Successfully refreshed databased."}
+        job, started = ingest_jobs.submit()
+        message = "Database refresh started." if started else "Database refresh already in progress."
+        return {"status": 200,
+                "message": message,
+                "data": job}
     except Exception as e:
-        return {"status":500 , "message": f"Error while refreshing database: {e}"}
+        return {"status":500 , "message": f"Error while refreshing database: {e}", "data": None}
+
+@router.get("/database/refresh/{job_id}")
+async def get_refresh_status(job_id: str):
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        return {"status": 404, "message": f"No refresh job found with id {job_id}", "data": None}
+    return {"status": 200,
+            "message": "refresh job status retrieved successfully",
+            "data": job}
@@ -0,0 +1,104 @@
+'''
+Support for serving with several uvicorn worker processes (python main.py --workers N).
+
+The loader process makes sure an up-to-date snapshot is on disk before starting the workers.
+Each worker then attaches to that snapshot instead of building its own dataframes, so the matrices
+are memory-mapped once and shared by every worker. A refresh runs in whichever worker received it
+and writes a new snapshot generation, which the other workers pick up by watching metadata.json.
+'''
+from contextlib import asynccontextmanager
+from Utils.snapshot import SNAPSHOT_DIR, load_snapshot, snapshot_stamp
+import asyncio
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where only single-worker serving is supported
+    fcntl = None
+
+# How often workers check for a new snapshot generation
+SNAPSHOT_POLL_SECONDS = 1.0
+
+REFRESH_LOCK_FILE = 'refresh.lock'
+
+
+class SnapshotWatcher:
+    """
+    Keeps a worker's dataframes in step with the snapshot on disk. on_change is called with the
+    dataframes of every new snapshot generation, starting with the current one.
+    """
+
+    def __init__(self, on_change, directory=SNAPSHOT_DIR, interval=SNAPSHOT_POLL_SECONDS):
+        self.on_change = on_change
+        self.directory = directory
+        self.interval = interval
+        self.stamp = None
+        self.task = None
+
+    def is_running(self):
+        return self.task is not None
+
+    async def start(self):
+        """Attach to the current snapshot and start polling for newer ones"""
+        if not await self.check():
+            raise Exception(f"No usable dataframe snapshot found in {self.directory}")
+        self.task = asyncio.create_task(self.watch())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def check(self):
+        """Load the snapshot if it changed since the last check. Returns whether one was loaded."""
+        stamp = snapshot_stamp(self.directory)
+        if stamp is None or stamp == self.stamp:
+            return False
+
+        loop = asyncio.get_running_loop()
+        dataframes = await loop.run_in_executor(None, load_snapshot, None, self.directory)
+        if dataframes is None:
+            # Most likely replaced again while loading, the next check picks up the newer one
+            return False
+
+        self.stamp = stamp
+        self.on_change(dataframes)
+        return True
+
+    def mark_written(self):
+        """
+        Take the snapshot this worker just wrote from its own dataframes as loaded, so check
+        doesn't load it again and publish the same dataframes a second time
+        """
+        self.stamp = snapshot_stamp(self.directory)
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                print(f"Something went wrong while checking for a new dataframe snapshot: {e}")
+
+
+@asynccontextmanager
+async def refresh_lock(directory=SNAPSHOT_DIR):
+    """
+    Hold an exclusive lock shared by every process serving from directory, so only one worker
+    ingests and writes a snapshot at a time. The lock is waited for in an executor so the event
+    loop keeps serving requests meanwhile.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    os.makedirs(directory, exist_ok=True)
+    file = open(os.path.join(directory, REFRESH_LOCK_FILE), 'w')
+    try:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, fcntl.flock, file.fileno(), fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the file releases the lock
+        file.close()
@@ -1,10 +1,29 @@
-import sys
+import os
+import json
+import time
+import uuid
+import hashlib
 import asyncio
+import argparse
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
-from Utils.db import (add_new_statement, add_new_securities, statement_exists,
-                      add_new_total_total, add_new_unrealized_total, add_new_realized_total)
+from Utils.db import get_statement_keys, get_statement_signature, add_statement_batch, TOTAL_TABLES
 from Utils.fileprocessor import FileProcessor
+from Utils.manifest import IngestManifest
+from Utils.DataframeLoader import StatementColumns, PNL_RELATIONS
+
+# Statements written per transaction while ingesting
+INGEST_BATCH_SIZE = 100
+
+# Raw statement files parsed and aggregated at a time by add_raw_data, which bounds its memory
+# use to one chunk of files regardless of how many there are
+RAW_FILES_PER_CHUNK = 50
+
+# Column of the Realized & Unrealized Performance Summary holding each P&L type
+RAW_PNL_COLUMNS = {'total': 'Total', 'realized_total': 'Realized Total', 'unrealized_total': 'Unrealized Total'}
+
+STATEMENT_KEY = ['statement_start', 'statement_end', 'account_name']
 
 
 def split_df(dataframe: DataFrame):
@@ -23,108 +42,443 @@ def split_df(dataframe: DataFrame):
     return {"statement_info": statement_info, "security_info": securities}
 
 
-async def add_data(filepath):
+class IngestProgress:
+    """
+    Counters and per-stage timings for one run of add_data. add_data updates it as it goes,
+    so it can be read while the ingest is still running.
+    """
+
+    def __init__(self):
+        self.stage = None
+        self.stage_started = None
+        self.stages = {}
+        self.files_processed = 0
+        self.files_unchanged = 0
+        self.statements_inserted = 0
+        # Keys of the stored statements that modified files changed, which are replaced
+        self.changed_statements = []
+        self.file_errors = []
+        self.error = None
+
+    def start_stage(self, stage):
+        self.finish_stage()
+        self.stage = stage
+        self.stage_started = time.perf_counter()
+
+    def finish_stage(self):
+        # Stages are entered once per chunk by add_raw_data, so their times add up
+        if self.stage is not None:
+            self.stages[self.stage] = self.stages.get(self.stage, 0) + time.perf_counter() - self.stage_started
+            self.stage = None
+
+    def to_dict(self):
+        stages = dict(self.stages)
+        if self.stage is not None:
+            stages[self.stage] = stages.get(self.stage, 0) + time.perf_counter() - self.stage_started
+        return {"stage": self.stage,
+                "files_processed": self.files_processed,
+                "files_unchanged": self.files_unchanged,
+                "statements_inserted": self.statements_inserted,
+                "changed_statements": self.changed_statements,
+                "stage_seconds": stages,
+                "file_errors": self.file_errors,
+                "error": self.error}
+
+
+def read_trade_data(filepath, progress: IngestProgress):
+    """
+    Load the prepared CSV files in filepath and split them into the statement information
+    and the securities of each total. This is the CPU-bound part of an ingest, so add_data
+    runs it in an executor.
+    """
+    fileproc = FileProcessor(filepath, debug_level=0)
+    files = fileproc.get_csv_files()
+
+    trade_data = {}
+
+    for file in files:
+        df = fileproc.load_prepared_data(file)
+        trade_data[file.strip('.csv')] = split_df(df)
+        progress.files_processed += 1
+
+    statement_data = []
+    for data_type, frames in trade_data.items():
+        statement_data.append(frames['statement_info'])
+
+    # Construct Statement dataframe
+    statement_info_df = pd.concat(statement_data, axis=1)  # concatenate dataframes along columns
+    statement_info = statement_info_df.loc[:,
+                     ~statement_info_df.columns.duplicated()]  # remove duplicate columns by keeping the first occurrence
+
+    # Get remaining dataframes
+    realized_total = trade_data['realized_total']['security_info']
+    unrealized_total = trade_data['unrealized_total']['security_info']
+    total = trade_data['total']['security_info']
+
+    return statement_info, realized_total, unrealized_total, total
+
+
+def read_statements(filepath, progress: IngestProgress):
+    """
+    read_trade_data, then the key, the prepare_statements record and a hash of every statement
+    in the files. All of it is pandas work, so add_data runs it in an executor.
+    """
+    statement_info, realized_total, unrealized_total, total = read_trade_data(filepath, progress)
+    securities = {'total': total, 'realized_total': realized_total, 'unrealized_total': unrealized_total}
+
+    keys = list(zip(statement_info['statement_start'], statement_info['statement_end'],
+                    statement_info['account_name']))
+    statements = prepare_statements(statement_info, securities)
+    return keys, statements, [statement_hash(statement) for statement in statements]
+
+
+def canonical_value(value):
+    """Numbers as floats, so a column read as int one time and float the next hashes the same"""
+    if isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def statement_hash(statement):
+    """
+    Hash of a prepare_statements record, over its non-missing fields and totals and the sorted
+    (symbol, value) pairs of each P&L type. It only covers the statement's own data, so it doesn't
+    change when the files gain columns for other statements' symbols, or reorder or retype them.
+    """
+    statement_data, total_values, security_values = statement
+    fields = sorted((field, canonical_value(value)) for field, value in {**statement_data, **total_values}.items()
+                    if value is not None)
+    securities = {pnl_type: sorted(zip(symbols, map(canonical_value, values)))
+                  for pnl_type, (symbols, values) in security_values.items()}
+    encoded = json.dumps([fields, securities], sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+async def load_manifest():
+    """
+    The ingest manifest, less the files whose statements are no longer all in the database, and
+    the keys of the statements in the database if they had to be read for that. They only are
+    when statements were added or removed since the manifest was saved.
+    """
+    manifest = IngestManifest.load()
+    if manifest.database == await get_statement_signature():
+        return manifest, None
+
+    existing = await get_statement_keys()
+    manifest.drop_missing(existing)
+    return manifest, existing
+
+
+def previous_statement_hashes(manifest: IngestManifest, fileproc: FileProcessor, files):
+    """{statement key: hash} the manifest recorded for the statements of files"""
+    previous = {}
+    for file in files:
+        previous.update(manifest.statement_hashes(os.path.join(fileproc.trades_dir, file)))
+    return previous
+
+
+def find_changed_statements(keys, hashes, previous, existing, progress: IngestProgress):
+    """
+    Keys of the statements already in the database (existing) that a modified file now holds
+    differently from when it was recorded (previous hashes). They are listed in
+    progress.changed_statements and removed from existing, so they are inserted again, replacing
+    the stored version.
+    """
+    changed = set()
+    for key, statement_hash in zip(keys, hashes):
+        if key in existing and previous.get(key, statement_hash) != statement_hash:
+            progress.changed_statements.append(list(key))
+            changed.add(key)
+    existing.difference_update(changed)
+    return changed
+
+
+def prepare_statements(statement_info, securities):
+    """
+    The statements of statement_info, whose securities of each P&L type are in the dataframes of
+    securities (in the same row order), as (statement fields, totals, {pnl_type: (symbols, values)})
+    records, the form build_statement_batch and StatementColumns take.
+
+    Missing statement fields and totals are None, as the prepared files already give them, rather
+    than a float NaN. Securities without a value are left out, the loader reads them back as
+    missing either way.
+    """
+    fields = [{field: None if pd.isna(value) else value for field, value in record.items()}
+              for record in statement_info.to_dict('records')]
+
+    # The (symbols, values) of each statement are a run of the non-missing cells, row by row
+    security_values = {}
+    for pnl_type in PNL_RELATIONS:
+        frame = securities[pnl_type]
+        matrix = frame.to_numpy(dtype=np.float64, na_value=np.nan)
+        rows, columns = np.nonzero(~np.isnan(matrix))
+        symbols = np.asarray(frame.columns, dtype=object)[columns]
+        values = matrix[rows, columns]
+        bounds = np.searchsorted(rows, np.arange(len(fields) + 1))
+        security_values[pnl_type] = [(symbols[start:end].tolist(), values[start:end].tolist())
+                                     for start, end in zip(bounds[:-1], bounds[1:])]
+
+    statements = []
+    for i, statement_data in enumerate(fields):
+        total_values = {relation: statement_data.pop(relation) for relation in TOTAL_TABLES}
+        statements.append((statement_data, total_values,
+                           {pnl_type: security_values[pnl_type][i] for pnl_type in PNL_RELATIONS}))
+    return statements
+
+
+def build_statement_batch(statements):
+    """
+    Build the database records for a batch of prepare_statements records, with client-generated
+    ids so statements, totals and securities can all be inserted together.
+
+    Returns the records for add_statement_batch along with the records given, their statement
+    fields carrying the new ids, for mirror_statements.
+    """
+    statement_records = []
+    totals = {relation: [] for relation in TOTAL_TABLES}
+    security_records = []
+    added = []
+
+    for statement_data, total_values, security_values in statements:
+        statement_id = str(uuid.uuid4())
+        statement_records.append({'id': statement_id, **statement_data})
+
+        for pnl_type, relation in PNL_RELATIONS.items():
+            total_id = str(uuid.uuid4())
+            totals[relation].append({'id': total_id, 'statement_id': statement_id, 'value': total_values[relation]})
+
+            _, foreign_key = TOTAL_TABLES[relation]
+            symbols, values = security_values[pnl_type]
+            security_records.extend({"symbol": symbol, "value": value, foreign_key: total_id}
+                                    for symbol, value in zip(symbols, values))
+
+        added.append(({'id': statement_id, **statement_data}, total_values, security_values))
+
+    return statement_records, totals, security_records, added
+
+
+def mirror_statements(new_statements: StatementColumns, added):
+    """Append the statements of a committed batch (see build_statement_batch) to new_statements"""
+    for statement_data, total_values, security_values in added:
+        row = new_statements.add_statement(statement_data)
+        for pnl_type, relation in PNL_RELATIONS.items():
+            symbols, values = security_values[pnl_type]
+            new_statements.add_total(pnl_type, row, total_values[relation])
+            new_statements.add_securities(pnl_type, [row] * len(symbols), symbols, values)
+
+
+async def insert_statements(statements, progress: IngestProgress, new_statements: StatementColumns,
+                            replaced=frozenset()):
+    """
+    Write prepare_statements records to the database, INGEST_BATCH_SIZE at a time and each batch
+    in one transaction, so a failure part-way leaves only whole statements behind. Statements
+    whose key is in replaced are deleted from the database in the batch that inserts their new
+    version. Committed statements are mirrored into new_statements. Building the records and
+    mirroring them run in an executor, so the event loop keeps serving requests during a large ingest.
+    """
+    loop = asyncio.get_running_loop()
+    for start in range(0, len(statements), INGEST_BATCH_SIZE):
+        batch = statements[start:start + INGEST_BATCH_SIZE]
+        statement_records, totals, security_records, added = await loop.run_in_executor(
+            None, build_statement_batch, batch)
+        batch_replaced = [key for key in (tuple(statement_data[field] for field in STATEMENT_KEY)
+                                          for statement_data, _, _ in batch) if key in replaced]
+
+        await add_statement_batch(statement_records, totals, security_records, batch_replaced)
+
+        # Only mirror statements once their batch is committed
+        await loop.run_in_executor(None, mirror_statements, new_statements, added)
+        new_statements.replaced.update(batch_replaced)
+        progress.statements_inserted += len(added)
+
+
+async def add_data(filepath="trades", progress: IngestProgress = None):
+    """
+    Add every statement found in the CSV files in filepath that isn't in the database yet, and
+    replace the stored statements modified files changed. Returns the inserted statements as
+    StatementColumns so callers can update their in-memory dataframes without reloading the
+    whole database.
+
+    The files are only read when one of them is new or modified since the ingest manifest
+    recorded them (see Utils/manifest.py). Statements are written INGEST_BATCH_SIZE at
+    a time, see insert_statements.
+    """
+    new_statements = StatementColumns()
+    if progress is None:
+        progress = IngestProgress()
+
     try:
+        progress.start_stage('find_new_statements')
+        manifest, existing = await load_manifest()
 
-        fileproc = FileProcessor(filepath, debug_level=0)
-        files = fileproc.get_csv_files()
+        progress.start_stage('read_files')
+        fileproc = FileProcessor(filepath, debug_level=0, manifest=manifest)
+        changed = fileproc.get_csv_files()
+        progress.files_unchanged = len(fileproc.file_states) - len(changed)
+        if not changed:
+            manifest.save(await get_statement_signature())
+            progress.finish_stage()
+            return new_statements
+
+        # The prepared files are one table split in three, so they are read together
+        loop = asyncio.get_running_loop()
+        keys, statements, hashes = await loop.run_in_executor(None, read_statements, filepath, progress)
+
+        # If the statement exists, no need to process any of it again
+        progress.start_stage('find_new_statements')
+        if existing is None:
+            existing = await get_statement_keys()
+        changed_statements = find_changed_statements(
+            keys, hashes, previous_statement_hashes(manifest, fileproc, fileproc.file_states), existing, progress)
+        rows = []
+        for i, key in enumerate(keys):
+            if key not in existing:
+                existing.add(key)
+                rows.append(i)
+
+        progress.start_stage('insert_statements')
+        await insert_statements([statements[i] for i in rows], progress, new_statements, changed_statements)
 
-        trade_data = {}
-
-        for file in files:
-            df = fileproc.load_prepared_data(file)
-            trade_data[file.strip('.csv')] = split_df(df)
-
-        statement_data = []
-        for data_type, frames in trade_data.items():
-            statement_data.append(frames['statement_info'])
-
-        # Construct Statement dataframe
-        statement_info_df = pd.concat(statement_data, axis=1)  # concatenate dataframes along columns
-        statement_info = statement_info_df.loc[:,
-                         ~statement_info_df.columns.duplicated()]  # remove duplicate columns by keeping the first occurrence
-
-        # Get remaining dataframes
-        realized_total = trade_data['realized_total']['security_info']
-        unrealized_total = trade_data['unrealized_total']['security_info']
-        total = trade_data['total']['security_info']
-
-        for i in range(len(statement_info.index)):
-            statement_data = statement_info.iloc[i].to_dict()
-
-            # If the statement exists, no need to process any of it again
-            if await statement_exists(statement_data):
-                continue
-
-            total_total_val = statement_data.pop('total_total')
-            realized_total_val = statement_data.pop('realized_total')
-            unrealized_total_val = statement_data.pop('unrealized_total')
-
-            # Add Statement record to DB
-            statement_record = await add_new_statement(statement_data)
-
-            # Add RealizedTotal record to DB
-            realized_total_record = await add_new_realized_total({
-                'statement_id': statement_record.id,
-                'value': realized_total_val
-            })
-
-            # Add all RealizedTotal Securities to DB
-            await add_new_securities(
-                list(
-                    map(lambda tup: {
-                        "symbol": tup[0],
-                        "value": tup[1],
-                        "realized_total_id": realized_total_record.id
-                    },
-                        realized_total.iloc[i].items()
-                        )
-                )
-            )
-
-            # Add UnrealizedTotal record to DB
-            unrealized_total_record = await add_new_unrealized_total({
-                'statement_id': statement_record.id,
-                'value': unrealized_total_val
-            })
-
-            # Add all UnrealizedTotal Securities to DB
-            await add_new_securities(
-                list(
-                    map(lambda tup: {
-                        "symbol": tup[0],
-                        "value": tup[1],
-                        "unrealized_total_id": unrealized_total_record.id
-                    },
-                        unrealized_total.iloc[i].items()
-                        )
-                )
-            )
-
-            # Add TotalTotal record to DB
-            total_total_record = await add_new_total_total({
-                'statement_id': statement_record.id,
-                'value': total_total_val
-            })
-
-            # Add all TotalToal Securities to DB
-            await add_new_securities(
-                list(
-                    map(lambda tup: {
-                        "symbol": tup[0],
-                        "value": tup[1],
-                        "total_total_id": total_total_record.id
-                    },
-                        total.iloc[i].items()
-                        )
-                )
-            )
+        produced = dict(zip(keys, hashes))
+        for file, state in fileproc.file_states.items():
+            manifest.record(os.path.join(fileproc.trades_dir, file), state, produced)
+        manifest.save(await get_statement_signature())
 
+        progress.finish_stage()
     except Exception as e:
         print(f"Error while adding new data to db: {e}")
+        progress.error = str(e)
+        progress.finish_stage()
+
+    return new_statements
+
+
+def raw_statement_key(statement_info, account_info):
+    """(statement_start, statement_end, account_name) of a raw statement parsed by FileProcessor.extract_statement"""
+    return statement_info['start_date'], statement_info['end_date'], account_info['id']
+
+
+def aggregate_raw_statements(parsed, existing):
+    """
+    Turn FileProcessor.extract_statement results for a set of raw statements into the
+    prepare_statements records insert_statements takes, as read_statements does for the
+    prepared CSV files.
+
+    The Realized & Unrealized Performance Summary rows of all the statements are summed per
+    (statement, account, underlying) with a single groupby. Statements whose key is in existing
+    (or repeated within parsed) are skipped, and the keys of the others are added to existing.
+    """
+    statements = []
+    trades = []
+    for df, statement_info, account_info, nav_values in parsed:
+        key = raw_statement_key(statement_info, account_info)
+        if key in existing:
+            continue
+        existing.add(key)
+        statements.append({**dict(zip(STATEMENT_KEY, key)), **nav_values})
+        trades.append(df[['underlying', *RAW_PNL_COLUMNS.values()]])
+
+    if not statements:
+        return []
+
+    statement_info = pd.DataFrame(statements)
+
+    lengths = [len(trade) for trade in trades]
+    trades = pd.concat(trades, ignore_index=True)
+    trades['statement'] = np.repeat(np.arange(len(lengths)), lengths)
+    trades['underlying'] = trades['underlying'].str.upper()
+    for column in RAW_PNL_COLUMNS.values():
+        trades[column] = pd.to_numeric(trades[column].str.replace(',', '', regex=False), errors='coerce')
+
+    # The statement number stands for its (start, end, account) key
+    summed = trades.groupby(['statement', 'underlying'], sort=False)[list(RAW_PNL_COLUMNS.values())].sum(min_count=1)
+
+    securities = {}
+    for pnl_type, column in RAW_PNL_COLUMNS.items():
+        values = summed[column].unstack('underlying').reindex(statement_info.index)
+        values.columns.name = None
+        securities[pnl_type] = values
+        statement_info[PNL_RELATIONS[pnl_type]] = values.sum(axis=1, min_count=1)
+
+    return prepare_statements(statement_info, securities)
+
+
+async def add_raw_data(filepath="trades", progress: IngestProgress = None, workers=1):
+    """
+    Add every statement found in the raw broker statements in filepath that isn't in the
+    database yet, and replace the stored statements modified files changed, without going
+    through the prepared CSV files. Returns the inserted statements as StatementColumns, like add_data.
+
+    Only the files that are new or modified since the ingest manifest recorded them are read
+    (see Utils/manifest.py). They are parsed (over workers processes) and aggregated
+    RAW_FILES_PER_CHUNK at a time, and each chunk is written and recorded in the manifest before
+    the next one is read. Files that fail to parse are recorded in progress.file_errors and skipped.
+    """
+    new_statements = StatementColumns()
+    if progress is None:
+        progress = IngestProgress()
+
+    try:
+        progress.start_stage('find_new_statements')
+        manifest, existing = await load_manifest()
+
+        loop = asyncio.get_running_loop()
+        fileproc = FileProcessor(filepath, debug_level=0, manifest=manifest)
+        files = fileproc.get_csv_files()
+        progress.files_unchanged = len(fileproc.file_states) - len(files)
+        if files and existing is None:
+            existing = await get_statement_keys()
+
+        for start in range(0, len(files), RAW_FILES_PER_CHUNK):
+            chunk = files[start:start + RAW_FILES_PER_CHUNK]
+
+            progress.start_stage('read_files')
+            results, errors = await loop.run_in_executor(
+                None, fileproc.process_files, 'extract_statement', chunk, workers)
+            progress.files_processed += len(chunk)
+            for file, message in errors:
+                print(f"Skipping raw statement {file}: {message}")
+                progress.file_errors.append({"file": file, "error": message})
+
+            # A raw statement file holds a single statement, so the file's hash is the statement's
+            keys = [raw_statement_key(result[1], result[2]) for _, result in results]
+            hashes = [fileproc.file_states[file][2] for file, _ in results]
+            changed_statements = find_changed_statements(
+                keys, hashes, previous_statement_hashes(manifest, fileproc, chunk), existing, progress)
+
+            progress.start_stage('aggregate_statements')
+            statements = await loop.run_in_executor(
+                None, aggregate_raw_statements, [result for _, result in results], existing)
+
+            progress.start_stage('insert_statements')
+            await insert_statements(statements, progress, new_statements, changed_statements)
+
+            for (file, _), key, statement_hash in zip(results, keys, hashes):
+                manifest.record(os.path.join(fileproc.trades_dir, file), fileproc.file_states[file],
+                                {key: statement_hash})
+            manifest.save(await get_statement_signature())
+
+        manifest.save(await get_statement_signature())
+        progress.finish_stage()
+    except Exception as e:
+        print(f"Error while adding raw statements to db: {e}")
+        progress.error = str(e)
+        progress.finish_stage()
+
+    return new_statements
+
 
 if __name__ == '__main__':
-    filepath = "trades"
-    if len(sys.argv) == 2:
-        filepath = sys.argv[1]
-    asyncio.run(add_data(filepath))
+    parser = argparse.ArgumentParser(description="Add new statements to the database")
+    parser.add_argument('filepath', nargs='?', default="trades",
+                        help="Directory of the statement CSV files, relative to the current directory")
+    parser.add_argument('--raw', action='store_true',
+                        help="Read raw broker statements instead of the prepared total CSV files")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Processes parsing raw statements")
+    args = parser.parse_args()
+
+    if args.raw:
+        asyncio.run(add_raw_data(args.filepath, workers=args.workers))
+    else:
+        asyncio.run(add_data(args.filepath))
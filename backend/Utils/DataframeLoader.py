@@ -1,72 +1,296 @@
-from Utils.db import get_all_records
+from Utils.db import iter_statement_pages, iter_total_pages, iter_security_pages
+from Utils.aggregatecube import AggregateCube
+from Utils.dataframeprocessor import get_security_columns, get_security_store
+from Utils.sparsestore import SparseSecurities
 from typing import List, Dict
+from array import array
+import numpy as np
 import pandas as pd
 
+# Dataframes built by the loader, keyed by the Statement relation that holds their securities
+PNL_TYPES = ['total', 'realized_total', 'unrealized_total']
+PNL_RELATIONS = {'total': 'total_total',
+                 'realized_total': 'realized_total',
+                 'unrealized_total': 'unrealized_total'}
+
+# dtype of the security value matrices. float32 halves the memory they take, but only keeps
+# about 7 significant digits of each value, so amounts above ~100,000 lose their cents
+SECURITY_VALUE_DTYPE = np.float64
+
+# How the security values are held: 'sparse' keeps only the values a statement actually has in a
+# SparseSecurities store (see Utils/sparsestore.py), in the dataframes and in the cube, which takes
+# a fraction of the memory of 'dense', one column per symbol in each dataframe and a dense
+# (date x account x symbol) cube. A statement holds few of the symbols ever traded, so the dense
+# layout is mostly empty and grows with the whole symbol universe.
+SECURITY_STORE = 'sparse'
+
+STATEMENT_DATE_COLUMNS = ['statement_start', 'statement_end']
+
+# The three dataframes share their statement columns (see assemble_dataframes). Copy-on-write,
+# on for the whole process, makes a write to one of them copy those columns first, so it can't
+# show up in the others, and keeps concat from copying the columns it is given.
+pd.set_option('mode.copy_on_write', True)
+
+
+class StatementColumns:
+    """
+    Flat columnar buffers for a batch of statements.
+
+    Statement fields are kept as one list per field, and the securities of each
+    P&L type as parallel (row, symbol code, value) arrays, so the wide dataframes
+    can be materialised with a single construction instead of one concat per statement.
+    replaced holds the (statement_start, statement_end, account_name) keys of statements that
+    replace ones already in the database, rather than adding to them.
+    """
+
+    def __init__(self):
+        self.length = 0
+        self.replaced = set()
+        self.rows = {}
+        self.statements = {}
+        self.totals = {pnl_type: [] for pnl_type in PNL_TYPES}
+        self.symbols = {pnl_type: {} for pnl_type in PNL_TYPES}
+        self.securities = {pnl_type: {'row': array('q'), 'code': array('q'), 'value': array('d')}
+                           for pnl_type in PNL_TYPES}
+
+    def add_statement(self, statement_data: Dict):
+        """Append the scalar fields of one statement and return its row number"""
+        row = self.length
+        self.rows[statement_data.pop('id')] = row
+        for field, value in statement_data.items():
+            self.statements.setdefault(field, []).append(value)
+        self.length += 1
+        for pnl_type in PNL_TYPES:
+            self.totals[pnl_type].append(np.nan)
+        return row
+
+    def add_total(self, pnl_type: str, row: int, value):
+        self.totals[pnl_type][row] = value
+
+    def add_securities(self, pnl_type: str, rows: List[int], symbols: List[str], values: List):
+        """Append securities as (row, symbol code, value) triples"""
+        codes = self.symbols[pnl_type]
+        buffer = self.securities[pnl_type]
+        buffer['row'].extend(rows)
+        buffer['code'].extend([codes.setdefault(symbol, len(codes)) for symbol in symbols])
+        buffer['value'].extend([np.nan if value is None else value for value in values])
+
+
+async def fetch_statement_columns():
+    """
+    Stream the Statement, total and Security tables out of the database with flat raw queries
+    and gather them into StatementColumns, one page at a time.
+    """
+    columns = StatementColumns()
+
+    async for page in iter_statement_pages():
+        for statement_data in page:
+            statement_data.pop('_rowid')
+            columns.add_statement(statement_data)
+
+    for pnl_type in PNL_TYPES:
+        relation = PNL_RELATIONS[pnl_type]
+
+        async for page in iter_total_pages(relation):
+            for total_data in page:
+                columns.add_total(pnl_type, columns.rows[total_data['statement_id']], total_data['value'])
+
+        async for page in iter_security_pages(relation):
+            columns.add_securities(pnl_type,
+                                   [columns.rows[security['statement_id']] for security in page],
+                                   [security['symbol'] for security in page],
+                                   [security['value'] for security in page])
+
+    return columns
+
 
 async def load_dataframes():
     try:
-        records = await get_all_records()
+        columns = await fetch_statement_columns()
+        return build_dataframes(columns)
+    except Exception as e:
+        print(f"Something went wrong while loading data from the database: {e}")
+
+
+def build_dataframes(columns: StatementColumns):
+    """
+    Materialise the total, realized_total and unrealized_total dataframes from columnar buffers,
+    along with the AggregateCube summarising them under the 'cube' key
+    """
+    if columns.length == 0:
+        return with_cube({pnl_type: pd.DataFrame() for pnl_type in PNL_TYPES})
+
+    construct = construct_securities_store if SECURITY_STORE == 'sparse' else construct_securities_df
+    securities = {pnl_type: construct(columns, pnl_type) for pnl_type in PNL_TYPES}
+    return with_cube(assemble_dataframes(compact_statements(columns.statements), columns.totals, securities))
 
-        if records is None:
-            raise
 
-        dataframes = {'total': pd.DataFrame(),
-                      'realized_total': pd.DataFrame(),
-                      'unrealized_total': pd.DataFrame()}
+def compact_statements(statements):
+    """
+    Statement table shared by the three dataframes, from a dict of columns or a dataframe:
+    statement dates as datetime64, so date lookups compare integers rather than strings,
+    and account_name as a categorical
+    """
+    statement_df = pd.DataFrame(statements)
+    for column in STATEMENT_DATE_COLUMNS:
+        statement_df[column] = pd.to_datetime(statement_df[column])
+    statement_df['account_name'] = statement_df['account_name'].astype(str).astype('category')
+    return statement_df
 
-        for record in records:
-            statement_data = record.model_dump()
-            total_total_data = statement_data.pop('total_total')
-            realized_total_data = statement_data.pop('realized_total')
-            unrealized_total_data = statement_data.pop('unrealized_total')
 
-            statement_df = construct_statement_df(statement_data)
+def assemble_dataframes(statement_df, totals, securities):
+    """
+    Build the total, realized_total and unrealized_total dataframes around one statement table.
+    totals maps each P&L type to its per-statement totals and securities to its (statement x symbol)
+    dataframe or SparseSecurities, both in the row order of statement_df.
 
-            realized_total_df = construct_total_df(realized_total_data, statement_df)
-            unrealized_total_df = construct_total_df(unrealized_total_data, statement_df)
-            total_df = construct_total_df(total_total_data, statement_df)
+    The rows are sorted by statement_end and account_name once for all three dataframes, which are
+    then put together without copying, so every dataframe references the same statement columns
+    and only the security values are held once per P&L type.
 
-            total_df.insert(loc=3, column='total_total', value=[total_total_data['value']])
-            realized_total_df.insert(loc=3, column='realized_total', value=[realized_total_data['value']])
-            unrealized_total_df.insert(loc=3, column='unrealized_total', value=[unrealized_total_data['value']])
+    A SparseSecurities store is kept in the attrs of its dataframe rather than as columns, and the
+    statement_row column gives the store row of each dataframe row, so selections can still find
+    their values (see dataframeprocessor.get_security_store).
+    """
+    order = np.lexsort((statement_df['account_name'].cat.codes.to_numpy(),
+                        statement_df['statement_end'].to_numpy()))
+    if np.array_equal(order, np.arange(len(order))):
+        order = None
+    else:
+        statement_df = statement_df.take(order).reset_index(drop=True)
 
-            dataframes['total'] = pd.concat([dataframes['total'], total_df], axis=0, ignore_index=True)
-            dataframes['realized_total'] = pd.concat([dataframes['realized_total'], realized_total_df], axis=0, ignore_index=True)
-            dataframes['unrealized_total'] = pd.concat([dataframes['unrealized_total'], unrealized_total_df], axis=0, ignore_index=True)
+    sparse = any(isinstance(values, SparseSecurities) for values in securities.values())
+    if sparse:
+        statement_df = statement_df.assign(statement_row=np.arange(len(statement_df)))
 
+    # Indexed by statement_end, so date lookups on the dataframes are binary searches on the
+    # index rather than scans over every row. The index is left unnamed so statement_end is still a plain column.
+    index = pd.DatetimeIndex(statement_df['statement_end'].to_numpy())
+
+    dataframes = {}
+    for pnl_type in PNL_TYPES:
+        values = securities[pnl_type]
+        total = np.asarray(totals[pnl_type], dtype=np.float64)
+        if order is not None:
+            total = total[order]
+
+        frames = [statement_df, pd.DataFrame({PNL_RELATIONS[pnl_type]: total})]
+        if not sparse:
+            if order is not None:
+                values = pd.DataFrame(values.to_numpy()[order], columns=values.columns)
+            # astype copies even when the dtype already matches, e.g. memory-mapped snapshot matrices
+            if (values.dtypes != SECURITY_VALUE_DTYPE).any():
+                values = values.astype(SECURITY_VALUE_DTYPE)
+            frames.append(values)
+        elif order is not None:
+            values = values.take(order)
+
+        dataframe = pd.concat(frames, axis=1)
+        dataframe.index = index
+        if sparse:
+            dataframe.attrs['securities'] = values
+        dataframes[pnl_type] = dataframe
+
+    return dataframes
+
+
+def statement_table(dataframe):
+    """
+    The statement columns of one of the loaded dataframes, which come before its total column,
+    without the statement_row column of the sparse store
+    """
+    total_column = next(i for i, column in enumerate(dataframe.columns) if column in PNL_RELATIONS.values())
+    return dataframe.iloc[:, :total_column].drop(columns='statement_row', errors='ignore')
+
+
+def with_cube(dataframes):
+    """Add the AggregateCube of the dataframes under the 'cube' key"""
+    dataframes['cube'] = AggregateCube.from_dataframes({pnl_type: dataframes[pnl_type] for pnl_type in PNL_TYPES})
+    return dataframes
+
+
+def append_dataframes(dataframes, columns: StatementColumns):
+    """
+    Return new copies of the dataframes with the statements in columns appended.
+    The dataframes passed in are left untouched, so readers holding them are unaffected.
+    """
+    if columns.length == 0:
         return dataframes
-    except Exception as e:
-        print(f"Something went wrong while loading data from the database: {e}")
 
+    new_dataframes = build_dataframes(columns)
+    if dataframes['total'].empty:
+        return new_dataframes
 
-def remove_properties(obj: Dict, properties: List[str]):
-    for prop in properties:
-        obj.pop(prop)
+    statement_df = compact_statements(pd.concat([statement_table(dataframes['total']),
+                                                 statement_table(new_dataframes['total'])], ignore_index=True))
+    totals = {}
+    securities = {}
+    for pnl_type in PNL_TYPES:
+        relation = PNL_RELATIONS[pnl_type]
+        totals[pnl_type] = np.concatenate([dataframes[pnl_type][relation].to_numpy(),
+                                           new_dataframes[pnl_type][relation].to_numpy()])
+        frames = (dataframes[pnl_type], new_dataframes[pnl_type])
+        if SECURITY_STORE == 'sparse':
+            securities[pnl_type] = SparseSecurities.concat([get_security_store(frame) for frame in frames])
+        else:
+            securities[pnl_type] = pd.concat([frame[get_security_columns(frame)] for frame in frames],
+                                             axis=0, ignore_index=True)
 
+    appended = assemble_dataframes(statement_df, totals, securities)
+    # Only the new statements are aggregated, then merged into the existing cube
+    appended['cube'] = dataframes['cube'].merge(new_dataframes['cube'])
+    return appended
 
-def construct_total_df(realized_total_data: Dict, statement_df: pd.DataFrame):
+
+def security_triples(columns: StatementColumns, pnl_type: str):
+    """
+    Symbols of one P&L type in column order, and the (row, symbol code, value) triples of
+    their values, at most one per statement and symbol
+    """
+    symbols = list(columns.symbols[pnl_type])
+    buffer = columns.securities[pnl_type]
+
+    rows = np.frombuffer(buffer['row'], dtype=np.int64)
+    codes = np.frombuffer(buffer['code'], dtype=np.int64)
+    values = np.frombuffer(buffer['value'], dtype=np.float64)
+
+    # Order symbols by the first statement they appear in, then alphabetically, which is
+    # the column order the per-statement pivot_table and concat used to produce
+    first_rows = np.full(len(symbols), columns.length, dtype=np.int64)
+    np.minimum.at(first_rows, codes, rows)
+    order = sorted(range(len(symbols)), key=lambda code: (first_rows[code], symbols[code]))
+    symbols = [symbols[code] for code in order]
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    codes = ranks[codes]
+
+    # Keep the first non-null value of a symbol within a statement, as aggfunc='first' did
+    present = ~np.isnan(values)
+    rows, codes, values = rows[present], codes[present], values[present]
+    _, first = np.unique(rows * len(symbols) + codes, return_index=True)
+
+    return symbols, rows[first], codes[first], values[first]
+
+
+def construct_securities_df(columns: StatementColumns, pnl_type: str):
+    """Build the wide (statement x symbol) dataframe for one P&L type"""
     try:
-        exclude = ['id',
-                   'total_total', 'total_total_id',
-                   'unrealized_total', 'unrealized_total_id',
-                   'realized_total', 'realized_total_id']
-        remove_properties(realized_total_data, ['id', 'statement', 'statement_id'])
-
-        # Add securities to dataframe
-        for security_record in realized_total_data['securities']:
-            remove_properties(security_record, exclude)
-        sec_df = pd.DataFrame(realized_total_data['securities'])
-        pivoted_sec_df = sec_df.pivot_table(index=[], columns='symbol', values='value', aggfunc='first', dropna=False)
-        securities_df = pivoted_sec_df.reset_index(drop=True)
-
-        # Prepend statement data
-        realized_total_df = pd.concat([statement_df, securities_df], axis=1)
-        return realized_total_df
+        symbols, rows, codes, values = security_triples(columns, pnl_type)
+
+        matrix = np.full((columns.length, len(symbols)), np.nan, dtype=SECURITY_VALUE_DTYPE)
+        matrix[rows, codes] = values
+
+        return pd.DataFrame(matrix, columns=pd.Index(symbols, dtype=object))
     except Exception as e:
-        print(f"Error while constructing realized total dataframe: {e}")
+        print(f"Error while constructing {pnl_type} dataframe: {e}")
         raise
 
 
-def construct_statement_df(statement_data: Dict):
-    statement_data.pop('id')
-    return pd.DataFrame([statement_data])
+def construct_securities_store(columns: StatementColumns, pnl_type: str):
+    """Build the sparse (statement x symbol) store for one P&L type"""
+    try:
+        symbols, rows, codes, values = security_triples(columns, pnl_type)
+        return SparseSecurities.from_triples(symbols, columns.length, rows, codes, values, SECURITY_VALUE_DTYPE)
+    except Exception as e:
+        print(f"Error while constructing {pnl_type} store: {e}")
+        raise
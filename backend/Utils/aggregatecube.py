@@ -0,0 +1,328 @@
+'''
+Per-date, per-account aggregates of the loaded dataframes.
+
+Every dashboard metric is additive across accounts, so the statements are summed once at load
+time into dense (date x account x ...) arrays. A query for any subset of accounts then becomes a
+small NumPy reduction over the account axis instead of a filter and sum over raw rows.
+
+With the sparse security store the security sums stay sparse too, one SparseSecurities row per
+(date, account) cell with statements, as a dense block would again grow with dates x accounts x symbols.
+'''
+from Utils.dataframeprocessor import get_available_securities, get_security_store, normalize_date, rank_securities
+from Utils.sparsestore import SparseSecurities
+import numpy as np
+
+CARD_METRICS = ['total_gains', 'realized_gains', 'unrealized_gains', 'interest', 'dividends']
+
+
+def statement_metrics(dataframe):
+    """
+    Per-statement values of the card metrics. Once summed, total gains, realized, unrealized
+    and interest count a missing value as 0, while dividends stays NaN, as the cards always have.
+    """
+    values = {column: dataframe[column].to_numpy(dtype=np.float64) for column in [
+        'ending_value', 'transferred_pl_adjustments', 'deposits_and_withdrawals', 'dividends',
+        'starting_value', 'dividend_accruals', 'interest', 'interest_accruals', 'other_fee',
+        'realized_pl', 'change_in_unrealized_pl']}
+
+    total_gains = (values['ending_value'] - values['transferred_pl_adjustments']
+                   - values['deposits_and_withdrawals'] + values['dividends']
+                   - values['starting_value'] + values['dividend_accruals']
+                   - values['interest'] - values['interest_accruals'] + values['other_fee'])
+
+    return np.column_stack([np.nan_to_num(total_gains),
+                            np.nan_to_num(values['realized_pl']),
+                            np.nan_to_num(values['change_in_unrealized_pl']),
+                            np.nan_to_num(values['interest']),
+                            values['dividends'] + values['dividend_accruals']])
+
+
+class AggregateCube:
+    """
+    Aggregates of the total, realized_total and unrealized_total dataframes.
+
+    dates      sorted statement_end values, as datetime64[D]
+    accounts   sorted account names
+    present    (date x account) whether the account has a statement on that date
+    metrics    (date x account x metric) sums of the CARD_METRICS
+    securities {pnl_type: (date x account x symbol)} sums of each security, missing values as 0,
+               or a SparseSecurities of the same sums with one row per present cell, see cells
+    symbols    {pnl_type: [symbol, ...]} in the column order of the dataframe
+    cells      (date x account) row of each present cell in the sparse sums, -1 where absent.
+               The rows follow the present cells date by date, then account by account.
+    """
+
+    def __init__(self, dates, accounts, present, metrics, symbols, securities):
+        self.dates = dates
+        self.accounts = accounts
+        self.account_index = {account: i for i, account in enumerate(accounts)}
+        self.present = present
+        self.metrics = metrics
+        self.symbols = symbols
+        self.symbol_index = {pnl_type: {symbol: i for i, symbol in enumerate(pnl_symbols)}
+                             for pnl_type, pnl_symbols in symbols.items()}
+        self.securities = securities
+        self.cells = np.full(present.shape, -1, dtype=np.int64)
+        self.cells[present] = np.arange(np.count_nonzero(present))
+
+    @classmethod
+    def from_dataframes(cls, dataframes):
+        """
+        Aggregate a {pnl_type: dataframe} dict of dataframes sorted by statement_end and
+        account_name (see DataframeLoader.assemble_dataframes), so each (date, account) group is a
+        contiguous run of rows. The statement fields are read from the 'total' dataframe.
+        """
+        total = dataframes['total']
+        if total.empty:
+            return cls(np.array([], dtype='datetime64[D]'), [], np.zeros((0, 0), dtype=bool),
+                       np.zeros((0, 0, len(CARD_METRICS))),
+                       {pnl_type: [] for pnl_type in dataframes},
+                       {pnl_type: np.zeros((0, 0, 0)) for pnl_type in dataframes})
+
+        statement_ends = total['statement_end'].to_numpy()
+        account_names = total['account_name'].to_numpy()
+
+        dates, date_codes = np.unique(statement_ends.astype('datetime64[D]'), return_inverse=True)
+        accounts, account_codes = np.unique(account_names.astype(str), return_inverse=True)
+
+        # First row of every (date, account) group
+        group_keys = date_codes * len(accounts) + account_codes
+        starts = np.flatnonzero(np.r_[True, group_keys[1:] != group_keys[:-1]])
+        group_dates, group_accounts = date_codes[starts], account_codes[starts]
+
+        present = np.zeros((len(dates), len(accounts)), dtype=bool)
+        present[group_dates, group_accounts] = True
+
+        metrics = np.zeros((len(dates), len(accounts), len(CARD_METRICS)))
+        metrics[group_dates, group_accounts] = np.add.reduceat(statement_metrics(total), starts, axis=0)
+
+        symbols = {}
+        securities = {}
+        for pnl_type, dataframe in dataframes.items():
+            symbols[pnl_type] = get_available_securities(dataframe).tolist()
+            store = get_security_store(dataframe)
+            if store is None:
+                securities[pnl_type] = np.zeros((len(dates), len(accounts), len(symbols[pnl_type])))
+                if not len(symbols[pnl_type]):
+                    continue
+                values = np.nan_to_num(dataframe[symbols[pnl_type]].to_numpy(dtype=np.float64))
+                securities[pnl_type][group_dates, group_accounts] = np.add.reduceat(values, starts, axis=0)
+            else:
+                rows = dataframe['statement_row'].to_numpy()
+                if not np.array_equal(rows, np.arange(len(store))):
+                    store = store.take(rows)
+                securities[pnl_type] = store.group_sums(starts)
+                # Rows of the present cells in date, then account order (see cells)
+                order = np.argsort(group_keys[starts], kind='stable')
+                if not np.array_equal(order, np.arange(len(order))):
+                    securities[pnl_type] = securities[pnl_type].take(order)
+
+        return cls(dates, accounts.tolist(), present, metrics, symbols, securities)
+
+    def merge(self, other):
+        """
+        Return a new cube holding the sums of this cube and other, e.g. this cube plus one built
+        from newly added statements only. Neither cube is modified.
+        """
+        dates = np.union1d(self.dates, other.dates)
+        accounts = sorted(set(self.accounts) | set(other.accounts))
+        account_index = {account: i for i, account in enumerate(accounts)}
+
+        present = np.zeros((len(dates), len(accounts)), dtype=bool)
+        metrics = np.zeros((len(dates), len(accounts), len(CARD_METRICS)))
+        symbols = {pnl_type: self.symbols[pnl_type] + [symbol for symbol in other.symbols[pnl_type]
+                                                       if symbol not in self.symbol_index[pnl_type]]
+                   for pnl_type in self.symbols}
+        sparse = {pnl_type: any(isinstance(cube.securities[pnl_type], SparseSecurities) for cube in (self, other))
+                  for pnl_type in self.symbols}
+        securities = {pnl_type: np.zeros((len(dates), len(accounts), len(symbols[pnl_type])))
+                      for pnl_type in self.symbols if not sparse[pnl_type]}
+        positions = []
+
+        for cube in (self, other):
+            date_positions = np.searchsorted(dates, cube.dates)
+            account_positions = np.array([account_index[account] for account in cube.accounts], dtype=np.int64)
+            cells = np.ix_(date_positions, account_positions)
+            positions.append((date_positions, account_positions))
+
+            present[cells] |= cube.present
+            metrics[cells] += cube.metrics
+            for pnl_type in securities:
+                symbol_index = {symbol: i for i, symbol in enumerate(symbols[pnl_type])}
+                symbol_positions = np.array([symbol_index[symbol] for symbol in cube.symbols[pnl_type]],
+                                            dtype=np.int64)
+                securities[pnl_type][np.ix_(date_positions, account_positions, symbol_positions)] += \
+                    cube.securities[pnl_type]
+
+        cells = np.full(present.shape, -1, dtype=np.int64)
+        cells[present] = np.arange(np.count_nonzero(present))
+        for pnl_type in self.symbols:
+            if not sparse[pnl_type]:
+                continue
+            symbol_index = {symbol: i for i, symbol in enumerate(symbols[pnl_type])}
+            triples = []
+            for cube, (date_positions, account_positions) in zip((self, other), positions):
+                symbol_positions = np.array([symbol_index[symbol] for symbol in cube.symbols[pnl_type]],
+                                            dtype=np.int64)
+                cell_dates, cell_accounts, codes, values = cube.security_triples(pnl_type)
+                triples.append((cells[date_positions[cell_dates], account_positions[cell_accounts]],
+                                symbol_positions[codes], values))
+
+            rows, codes, values = (np.concatenate(arrays) for arrays in zip(*triples))
+            securities[pnl_type] = SparseSecurities.from_sums(symbols[pnl_type], np.count_nonzero(present),
+                                                              rows, codes, values)
+
+        return AggregateCube(dates, accounts, present, metrics, symbols, securities)
+
+    def security_triples(self, pnl_type):
+        """(date, account, symbol code, value) positions and values of the non-zero security sums"""
+        values = self.securities[pnl_type]
+        if isinstance(values, SparseSecurities):
+            cell_dates, cell_accounts = np.nonzero(self.present)
+            rows = values.row_numbers()
+            return cell_dates[rows], cell_accounts[rows], values.indices.astype(np.int64), values.data
+
+        cell_dates, cell_accounts, codes = np.nonzero(values)
+        return cell_dates, cell_accounts, codes, values[cell_dates, cell_accounts, codes]
+
+    def date_position(self, date):
+        position = np.searchsorted(self.dates, date)
+        if position < len(self.dates) and self.dates[position] == date:
+            return position
+        return None
+
+    def account_positions(self, accounts):
+        """Positions of the known accounts, in the same order the sorted dataframes hold them"""
+        return sorted({self.account_index[account] for account in accounts if account in self.account_index})
+
+    def select(self, accounts, start_date, end_date):
+        return CubeSelection(self, accounts, start_date, end_date)
+
+    def card_values(self, selection):
+        if selection.date is None or not self.present[selection.date, selection.positions].any():
+            raise Exception(f"No data found for account(s) {selection.accounts} on date {selection.end}")
+
+        sums = self.metrics[selection.date, selection.positions].sum(axis=0)
+        return {metric: sums[i] for i, metric in enumerate(CARD_METRICS)}
+
+    def security_totals(self, pnl_type, selection):
+        """Value of every security summed across the selected accounts on the end date, in column order"""
+        if selection.date is None:
+            return np.zeros(len(self.symbols[pnl_type]))
+
+        values = self.securities[pnl_type]
+        if isinstance(values, SparseSecurities):
+            rows = self.cells[selection.date, selection.positions]
+            return values.column_sums(rows[rows >= 0])
+        return values[selection.date, selection.positions].sum(axis=0)
+
+    def security_values(self, pnl_types, selection, securities):
+        """
+        Values of the securities for each P&L type over the selected date range, sharing one date axis:
+        {"date": [...], "series": {pnl_type: {security: [...]}}}
+        """
+        present = selection.range_present
+        if not present.any():
+            raise Exception(f"No data found for account(s) {selection.accounts} from {selection.start} to {selection.end}")
+
+        series = {}
+        for pnl_type in pnl_types:
+            symbols = [self.symbol_index[pnl_type][security] for security in securities]
+            store = self.securities[pnl_type]
+            if isinstance(store, SparseSecurities):
+                cells = self.cells[selection.range][:, selection.positions]
+                cell_dates, cell_accounts = np.nonzero(cells >= 0)
+                values = np.zeros((len(cells), len(securities)))
+                np.add.at(values, cell_dates,
+                          np.nan_to_num(store.to_dense(cells[cell_dates, cell_accounts], securities)))
+                values = values[present]
+            else:
+                values = store[selection.range]
+                values = values[np.ix_(np.arange(len(values)), selection.positions, symbols)].sum(axis=1)[present]
+            series[pnl_type] = {security: values[:, i].tolist() for i, security in enumerate(securities)}
+
+        return {"date": np.datetime_as_string(self.dates[selection.range][present]).tolist(), "series": series}
+
+    def graph_values(self, pnl_type, selection, security):
+        """Values of one security over the selected date range: {"date": [...], "value": [...]}"""
+        results = self.security_values([pnl_type], selection, [security])
+        return {"date": results["date"], "value": results["series"][pnl_type][security]}
+
+    def get_card_values(self, accounts, end_date):
+        """Total gains, realized gains, unrealized gains, interest and dividends for the accounts on end_date"""
+        try:
+            return self.card_values(self.select(accounts, end_date, end_date))
+        except Exception as e:
+            print(f"Something went wrong while getting card values: {e}")
+            raise e
+
+    def get_top_bottom(self, pnl_type, accounts, end_date, limit=None):
+        """Top-down and bottom-up securities for the accounts on end_date, see rank_securities"""
+        try:
+            totals = self.security_totals(pnl_type, self.select(accounts, end_date, end_date))
+            return rank_securities(self.symbols[pnl_type], totals, limit)
+        except Exception as e:
+            print(f"Something went wrong while getting top-down and bottom-up stocks: {e}")
+            raise e
+
+    def get_security_values(self, pnl_type, accounts, start_date, end_date, security):
+        """Values of one security for the accounts from start_date to end_date: {"date": [...], "value": [...]}"""
+        try:
+            return self.graph_values(pnl_type, self.select(accounts, start_date, end_date), security.upper())
+
+        except Exception as e:
+            print(f"Something went wrong while getting values for {security} from {start_date} to {end_date}: {e}")
+            raise e
+
+    def get_security_series(self, pnl_types, accounts, start_date, end_date, securities):
+        """Values of several securities for several P&L types, see security_values"""
+        try:
+            securities = list(dict.fromkeys(security.upper() for security in securities))
+            return self.security_values(pnl_types, self.select(accounts, start_date, end_date), securities)
+
+        except Exception as e:
+            print(f"Something went wrong while getting values for {securities} from {start_date} to {end_date}: {e}")
+            raise e
+
+    def get_dashboard(self, sections, pnl_type, accounts, start_date, end_date, security, limit=None):
+        """
+        Several sections of one dashboard view from a single account/date selection:
+        'card_data', 'graph_data' and 'top_down_bottom_up', each in the same form as its own endpoint.
+        A section that fails is returned as None, with its error under 'errors'.
+        """
+        selection = self.select(accounts, start_date, end_date)
+        queries = {
+            'card_data': lambda: self.card_values(selection),
+            'graph_data': lambda: self.graph_values(pnl_type, selection, security.upper()),
+            'top_down_bottom_up': lambda: rank_securities(self.symbols[pnl_type],
+                                                          self.security_totals(pnl_type, selection), limit),
+        }
+
+        results = {'errors': {}}
+        for section in sections:
+            try:
+                results[section] = queries[section]()
+            except Exception as e:
+                print(f"Something went wrong while getting the {section} dashboard section: {e}")
+                results[section] = None
+                results['errors'][section] = str(e)
+
+        return results
+
+
+class CubeSelection:
+    """
+    Cube positions of one account/date filter. Building it once lets every query of a dashboard
+    view share the same date lookups and account positions.
+    """
+
+    def __init__(self, cube: AggregateCube, accounts, start_date, end_date):
+        self.accounts = accounts
+        self.start = normalize_date(start_date)
+        self.end = normalize_date(end_date)
+        start, end = np.datetime64(self.start, 'D'), np.datetime64(self.end, 'D')
+        self.positions = cube.account_positions(accounts)
+        self.date = cube.date_position(end)
+        self.range = slice(np.searchsorted(cube.dates, start, side='left'),
+                           np.searchsorted(cube.dates, end, side='right'))
+        self.range_present = cube.present[self.range][:, self.positions].any(axis=1)
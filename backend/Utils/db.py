@@ -1,9 +1,21 @@
 from prisma import Prisma
-from prisma.errors import PrismaError, UniqueViolationError
+from prisma.errors import PrismaError
+from datetime import timedelta
 
 # Global database instance
 _db = None
 
+# WAL lets a refresh write while the server keeps reading, and is stored in the database file
+JOURNAL_PRAGMA = 'PRAGMA journal_mode = WAL'
+
+# Per connection settings, which reach every query since the datasource in schema.prisma limits
+# the client to one connection. In WAL mode synchronous NORMAL can only lose the last commits
+# on power loss, never corrupt the database, and saves an fsync per transaction.
+CONNECTION_PRAGMAS = ['PRAGMA synchronous = NORMAL',
+                      'PRAGMA cache_size = -65536',  # 64 MB
+                      'PRAGMA mmap_size = 268435456',  # 256 MB
+                      'PRAGMA temp_store = MEMORY']
+
 
 async def init_db():
     """Initialize the database connection."""
@@ -11,6 +23,9 @@ async def init_db():
     try:
         _db = Prisma()
         await _db.connect()
+        # query_raw rather than execute_raw, since these pragmas return their new value
+        for pragma in [JOURNAL_PRAGMA, *CONNECTION_PRAGMAS]:
+            await _db.query_raw(pragma)
     except PrismaError as e:
         print(f"Error connecting to database: {e}")
         raise
@@ -40,108 +55,145 @@ async def get_db():
         raise
 
 
-async def get_all_records():
-    try:
-        db = await get_db()
-        records = await db.statement.find_many(
-            include={
-                'total_total': {
-                    "include": {
-                        'securities': True
-                    }
-                },
-                'realized_total': {
-                    "include": {
-                        'securities': True
-                    }
-                },
-                'unrealized_total': {
-                    "include": {
-                        'securities': True
-                    }
-                },
-            }
-        )
-        return records
-    except Exception as e:
-        print(f"Error while getting all records in database: {e}")
-        raise
+# Rows fetched per raw query when streaming tables out of the database
+PAGE_SIZE = 50000
 
-
-async def add_new_statement(data):
-    db = await get_db()
-    try:
-        record = await db.statement.create(data)
-        return record
-    except UniqueViolationError as e:
-        print(f"Statement record already exists. You may be trying to\n"
-              f"scan an old statement")
-    except PrismaError as e:
-        print(f"Error creating new account: {e}")
-        raise
+# Parent table of each Statement relation, and the column linking Security rows to it
+TOTAL_TABLES = {'total_total': ('TotalTotal', 'total_total_id'),
+                'realized_total': ('RealizedTotal', 'realized_total_id'),
+                'unrealized_total': ('UnrealizedTotal', 'unrealized_total_id')}
 
 
-async def statement_exists(data):
-    db = await get_db()
+async def iter_pages(query, page_size=PAGE_SIZE):
+    """
+    Run a raw query in pages using keyset pagination and yield each page as a list of dicts.
+    The query must select a _rowid column and accept the last seen _rowid and the page size
+    as its two parameters, so each page picks up where the previous one ended.
+    """
     try:
-        record = await db.statement.find_unique(
-            where={
-                'statementdate_account': {
-                    'statement_start': data['statement_start'],
-                    'statement_end': data['statement_end'],
-                    'account_name': data['account_name'],
-                }
-            }
-        )
-        return record is not None
+        db = await get_db()
+        last_rowid = 0
+        while True:
+            rows = await db.query_raw(query, last_rowid, page_size)
+            if not rows:
+                break
+            last_rowid = rows[-1]['_rowid']
+            yield rows
+            if len(rows) < page_size:
+                break
     except PrismaError as e:
-        print(f"Error while checking if statement exists: {e}")
+        print(f"Error while streaming records from database: {e}")
         raise
 
 
-async def add_new_total_total(data):
+def iter_statement_pages(page_size=PAGE_SIZE):
+    """Stream every Statement row, in the same order find_many returns them"""
+    return iter_pages(
+        'SELECT rowid AS _rowid, * FROM Statement '
+        'WHERE rowid > ? ORDER BY rowid LIMIT ?',
+        page_size)
+
+
+def iter_total_pages(relation, page_size=PAGE_SIZE):
+    """Stream (statement_id, value) for the TotalTotal, RealizedTotal or UnrealizedTotal table"""
+    table, _ = TOTAL_TABLES[relation]
+    return iter_pages(
+        f'SELECT rowid AS _rowid, statement_id, value FROM {table} '
+        f'WHERE rowid > ? ORDER BY rowid LIMIT ?',
+        page_size)
+
+
+def iter_security_pages(relation, page_size=PAGE_SIZE):
+    """Stream (statement_id, symbol, value) for every Security belonging to one of the total tables"""
+    table, foreign_key = TOTAL_TABLES[relation]
+    return iter_pages(
+        f'SELECT Security.rowid AS _rowid, parent.statement_id, Security.symbol, Security.value '
+        f'FROM Security JOIN {table} AS parent ON parent.id = Security.{foreign_key} '
+        f'WHERE Security.rowid > ? ORDER BY Security.rowid LIMIT ?',
+        page_size)
+
+
+async def get_database_signature():
+    """
+    Cheap fingerprint of the database contents, used to tell whether a dataframe
+    snapshot is still current. Ingest appends rows, replacing a statement with new rows
+    rather than updating it, so the last rowid of each table changes whenever statements
+    are added or replaced.
+    """
     try:
         db = await get_db()
-        record = await db.totaltotal.create(data)
-        return record
-    except UniqueViolationError as e:
-        print(f"TotalTotal record already exists. You may be trying to scan an old statement.")
+        rows = await db.query_raw(
+            'SELECT (SELECT COUNT(*) FROM Statement) AS statements, '
+            '(SELECT MAX(rowid) FROM Statement) AS last_statement, '
+            '(SELECT COUNT(*) FROM Security) AS securities, '
+            '(SELECT MAX(rowid) FROM Security) AS last_security')
+        return rows[0]
     except PrismaError as e:
-        print(f"Error adding new total: {e}")
+        print(f"Error while computing database signature: {e}")
         raise
 
 
-async def add_new_realized_total(data):
+async def get_statement_signature():
+    """
+    Statement count and last rowid. Ingest appends statements and replaces changed ones with
+    new rows, so they change whenever statements are added or replaced, and whenever any are removed.
+    """
     try:
         db = await get_db()
-        record = await db.realizedtotal.create(data)
-        return record
-    except UniqueViolationError as e:
-        print(f"RealizedTotal record already exists. You may be trying to scan an old statement.")
+        rows = await db.query_raw(
+            'SELECT COUNT(*) AS statements, MAX(rowid) AS last_statement FROM Statement')
+        return rows[0]
     except PrismaError as e:
-        print(f"Error adding new realized total: {e}")
+        print(f"Error while computing statement signature: {e}")
         raise
 
 
-async def add_new_unrealized_total(data):
+# Longest a single ingest batch transaction may run before Prisma rolls it back
+BATCH_TRANSACTION_TIMEOUT = timedelta(minutes=2)
+
+
+async def get_statement_keys():
+    """(statement_start, statement_end, account_name) of every statement already in the database"""
     try:
         db = await get_db()
-        record = await db.unrealizedtotal.create(data)
-        return record
-    except UniqueViolationError as e:
-        print(f"UnrealizedTotal record already exists. You may be trying to scan an old statement.")
+        rows = await db.query_raw('SELECT statement_start, statement_end, account_name FROM Statement')
+        return {(row['statement_start'], row['statement_end'], row['account_name']) for row in rows}
     except PrismaError as e:
-        print(f"Error adding new unrealized total: {e}")
+        print(f"Error while getting existing statements: {e}")
         raise
 
 
-async def add_new_securities(data):
+async def delete_statements(transaction, keys):
+    """Delete the statements with (statement_start, statement_end, account_name) keys, with their totals and securities"""
+    parameters = [field for key in keys for field in key]
+    statement_ids = (f'SELECT id FROM Statement WHERE (statement_start, statement_end, account_name) '
+                     f'IN (VALUES {", ".join(["(?, ?, ?)"] * len(keys))})')
+    for table, foreign_key in TOTAL_TABLES.values():
+        await transaction.execute_raw(
+            f'DELETE FROM Security WHERE {foreign_key} IN '
+            f'(SELECT id FROM {table} WHERE statement_id IN ({statement_ids}))', *parameters)
+        await transaction.execute_raw(f'DELETE FROM {table} WHERE statement_id IN ({statement_ids})', *parameters)
+    await transaction.execute_raw(f'DELETE FROM Statement WHERE id IN ({statement_ids})', *parameters)
+
+
+async def add_statement_batch(statements, totals, securities, replaced=()):
+    """
+    Insert a batch of statements, their TotalTotal, RealizedTotal and UnrealizedTotal records
+    (totals, keyed by Statement relation) and their securities in a single transaction, so
+    either the whole batch is written or none of it is. Every record must already carry its id
+    and foreign keys. The stored statements with the (statement_start, statement_end,
+    account_name) keys in replaced are deleted in the same transaction, so the batch replaces them.
+    """
     try:
         db = await get_db()
-        record = await db.security.create_many(data)
-        return record
-    except UniqueViolationError as e:
-        print(f"Security record already exists. You may be trying to scan an old statement.")
+        async with db.tx(timeout=BATCH_TRANSACTION_TIMEOUT) as transaction:
+            if replaced:
+                await delete_statements(transaction, replaced)
+            await transaction.statement.create_many(statements)
+            await transaction.totaltotal.create_many(totals['total_total'])
+            await transaction.realizedtotal.create_many(totals['realized_total'])
+            await transaction.unrealizedtotal.create_many(totals['unrealized_total'])
+            await transaction.security.create_many(securities)
     except PrismaError as e:
-        print(f"Error creating new security: {e}")
+        print(f"Error adding batch of {len(statements)} statements: {e}")
         raise
@@ -1,13 +1,57 @@
 import os
 import csv
+import multiprocessing
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from dateutil import parser as dateparser
+from functools import lru_cache
+import re
+
+# Asset categories of the performance summary that are ingested
+TRADE_TYPES = ('Stocks', 'Equity and Index Options', 'Futures')
+
+# Futures symbols are root + month code (F = January ... Z = December) + year, e.g. MESH5
+FUTURES_MONTH_CODES = 'FGHJKMNQUVXZ'
+FUTURES_SYMBOL = re.compile(rf'([A-Z0-9]+?)[{FUTURES_MONTH_CODES}](\d{{1,2}})')
+
+# Roots whose underlying isn't the lower-cased root itself
+FUTURES_ROOT_OVERRIDES = {
+    'MCL': 'cl',  # micro crude is grouped with CL
+    'M3S': 'mes',
+}
+
+# Whole futures symbols that don't follow the root + month + year grammar
+FUTURES_SYMBOL_OVERRIDES = {}
+
+
+@lru_cache(maxsize=4096)
+def resolve_futures_underlying(symbol):
+    """Underlying of a futures symbol, e.g. 'MESH5' -> 'mes', 'MCLZ4' -> 'cl'"""
+    if symbol in FUTURES_SYMBOL_OVERRIDES:
+        return FUTURES_SYMBOL_OVERRIDES[symbol]
+    match = FUTURES_SYMBOL.fullmatch(symbol)
+    if match is None:
+        raise ValueError(f"No mapping found for futures symbol: {symbol}")
+    root = match.group(1)
+    return FUTURES_ROOT_OVERRIDES.get(root, root.lower())
+
+
+@lru_cache(maxsize=None)
+def section_pattern(section):
+    """Regex matching a run of consecutive lines whose first cell is section, quoted or not"""
+    cell = f'(?:{re.escape(section)}|"{re.escape(section)}")'
+    return re.compile(f'(?:{cell}(?:,[^\\n]*)?(?:\\n|\\Z))+')
+
+
+def run_file_method(trades_dir, debug_level, method, file):
+    """Run one FileProcessor method on one file, in a worker process of FileProcessor.process_files"""
+    return getattr(FileProcessor(trades_dir, debug_level), method)(file)
 
 
 class FileProcessor:
 
-    def __init__(self, trades_dir=None, debug_level=1):
+    def __init__(self, trades_dir=None, debug_level=1, manifest=None):
 
         # Setup directories
         if trades_dir is None:
@@ -16,6 +60,12 @@ class FileProcessor:
         self.root_dir = os.getcwd()
         self.trades_dir = os.path.join(self.root_dir, trades_dir)
         self.debug_level = debug_level
+        # ((path, size, mtime), sections) of the last raw statement read, see index_sections
+        self.section_index = None
+        # IngestManifest of the files already ingested, see get_csv_files
+        self.manifest = manifest
+        # {file: (size, mtime_ns, sha256)} of the files get_csv_files checked against the manifest
+        self.file_states = {}
 
         # Verify directories exist
         if not os.path.exists(self.trades_dir):
@@ -32,96 +82,119 @@ class FileProcessor:
         if self.debug_level >= level:
             print(f"[DEBUG-L{level}] {message}")
 
+    def index_sections(self, file):
+        """
+        Read a raw statement once and return (text, {section: [(row number, row), ...]}), the rows
+        of each section (the first cell of each row, e.g. 'Statement', 'Account Information',
+        'Change in NAV', 'Time Weighted Rate of Return' or 'Realized & Unrealized Performance
+        Summary') being filled in by section_rows as they are asked for. Sections nothing reads
+        (Trades, Mark-to-Market, ...) are never split into lines or tokenized.
+        The index of the last file read is cached, so all the extract methods share one read.
+        """
+        file_path = os.path.join(self.trades_dir, file)
+        stat = os.stat(file_path)
+        key = (file_path, stat.st_size, stat.st_mtime_ns)
+        if self.section_index is not None and self.section_index[0] == key:
+            return self.section_index[1]
+
+        self.debug_print(f"Opening file: {file_path}", 2)
+        with open(file_path, 'r') as csv_file:
+            text = csv_file.read()
+
+        for i, line in enumerate(text.split('\n', 5)[:5]):  # Print first 5 rows
+            self.debug_print(f"Row {i}: {line.strip()}", 2)
+
+        self.section_index = (key, (text, {}))
+        return self.section_index[1]
+
+    def section_rows(self, file, section):
+        """(row number, row) for every row of one section of a raw statement, see index_sections"""
+        text, sections = self.index_sections(file)
+        if section in sections:
+            return sections[section]
+
+        # Rows of a section are contiguous, so each section is one or a few runs of lines. Each run
+        # is found from an occurrence of the section name at the start of a line, and tokenized
+        # with one csv.reader
+        pattern = section_pattern(section)
+        rows = []
+        line_number, position, search = 1, 0, 0
+        while (found := text.find(section, search)) >= 0:
+            start = found - 1 if found and text[found - 1] == '"' else found
+            run = pattern.match(text, start) if start == 0 or text[start - 1] == '\n' else None
+            if run is None:
+                search = found + len(section)
+                continue
+
+            line_number += text.count('\n', position, start)
+            position = start
+            rows.extend((row_number, row) for row_number, row in
+                        enumerate(csv.reader(run.group().splitlines()), line_number) if row)
+            search = run.end()
+
+        sections[section] = rows
+        return rows
+
     def extract_trade_data(self, file):
         """Parse CSV file and extract trade data including the statement and account info,
             and a pandas dataframe with the trade data."""
 
         self.debug_print("Entering parse_csv()", 1)
 
-        file_path = os.path.join(self.trades_dir, file)
-
-        # First pass: get statement and account information
+        # Get statement and account information
         statement_info = {}
         account_info = {}
 
-        self.debug_print(f"Opening file: {file_path}", 2)
-        with open(file_path, 'r') as file:
-            # Print first few rows for debugging
-            self.debug_print("First few rows of the file:", 2)
-            for i, line in enumerate(file):
-
-                if i < 5:  # Print first 5 rows
-                    self.debug_print(f"Row {i}: {line.strip()}", 2)
-                row = next(csv.reader([line]))
-
-                # Stop scanning if we are no longer in the Statement or Account Information section
-                if not any('Statement' in str(cell) or 'Account Info' in str(cell) for cell in row):
-                    break
-
-                # Try to get all statement information
-                if 'Statement' in row and row[1] != 'Header':
-                    self.debug_print(f"Row Found for Statement: {row}", 2)
-                    if len(row) >= 4 and row[0] == 'Statement' and row[2] == 'Period':
-                        statement_period = self.parse_statement_period(row)
-                        statement_info.update(statement_period)
-                        if statement_period:
-                            self.debug_print(f"Successfully parsed statement period: {statement_period}", 2)
-                    else:
-                        label, value = self.parse_statement_info(row)
-                        statement_info.setdefault(label, value)
-                        if label and value:
-                            self.debug_print(f"Successfully parsed statement {label}: {value}", 2)
-
-                # Try to get all account information
-                if 'Account Information' in row and row[1] != 'Header':
-                    self.debug_print(f"Row Found for Account Information: {row}", 2)
-                    label, value = self.parse_account_info(row)
-                    account_info.setdefault(label, value)
+        for _, row in self.section_rows(file, 'Statement'):
+            # Try to get all statement information
+            if row[1] != 'Header':
+                self.debug_print(f"Row Found for Statement: {row}", 2)
+                if len(row) >= 4 and row[2] == 'Period':
+                    statement_period = self.parse_statement_period(row)
+                    statement_info.update(statement_period)
+                    if statement_period:
+                        self.debug_print(f"Successfully parsed statement period: {statement_period}", 2)
+                else:
+                    label, value = self.parse_statement_info(row)
+                    statement_info.setdefault(label, value)
                     if label and value:
-                        self.debug_print(f"Successfully parsed account {label}: {value}", 2)
+                        self.debug_print(f"Successfully parsed statement {label}: {value}", 2)
 
-        self.debug_print("Statement period not found in database, continuing with full processing", 2)
+        for _, row in self.section_rows(file, 'Account Information'):
+            # Try to get all account information
+            if row[1] != 'Header':
+                self.debug_print(f"Row Found for Account Information: {row}", 2)
+                label, value = self.parse_account_info(row)
+                account_info.setdefault(label, value)
+                if label and value:
+                    self.debug_print(f"Successfully parsed account {label}: {value}", 2)
 
         filtered_rows = []
-        parsed_symbols = []
-        errors = []
+        row_numbers = []
         headers = None
+        # Whether each asset category seen is one of TRADE_TYPES
+        trade_type_matches = {}
 
-        # Second pass: process all trade data
-        with open(file_path, 'r') as file:
-            reader = csv.reader(file)
-
-            self.debug_print("Starting full CSV parsing...", 2)
-            row_count = 0
-
-            for row in reader:
-                row_count += 1
+        # Process all trade data
+        self.debug_print("Starting trade data parsing...", 2)
+        for row_count, row in self.section_rows(file, 'Realized & Unrealized Performance Summary'):
+            if self.debug_level >= 3:
                 self.debug_print(f"Processing row {row_count}: {row}", 3)
 
-                # Find headers
-                if len(row) >= 2 and 'Realized & Unrealized Performance Summary' in row[0] and row[1] == 'Header':
-                    headers = row
-                    self.debug_print(f"Found headers: {headers}", 2)
-                    continue
-
-                # Process trade data
-                if headers and len(row) >= 3 and 'Realized & Unrealized Performance Summary' in row[0]:
-                    trade_type = row[2]
-                    if any(type_match in trade_type for type_match in
-                           ['Stocks', 'Equity and Index Options', 'Futures']):
-                        try:
-                            symbol_data = self.parse_symbol(row[3], trade_type)
-                            filtered_rows.append(row)
-                            parsed_symbols.append(symbol_data)
-                            self.debug_print(f"Found matching trade type: {trade_type}", 2)
-                        except ValueError as ve:
-                            errors.append(f"Row {row_count}: {str(ve)}")
-                            self.debug_print(f"Error processing row {row_count}: {str(ve)}", 1)
-
-        if errors:
-            error_msg = "\n".join(errors)
-            self.debug_print(f"Encountered errors while processing:\n{error_msg}", 1)
-            raise ValueError(f"Failed to process some futures symbols:\n{error_msg}")
+            # Find headers
+            if len(row) >= 2 and row[1] == 'Header':
+                headers = row
+                self.debug_print(f"Found headers: {headers}", 2)
+                continue
+
+            # Process trade data
+            if headers and len(row) >= 3:
+                trade_type = row[2]
+                if trade_type not in trade_type_matches:
+                    trade_type_matches[trade_type] = any(type_match in trade_type for type_match in TRADE_TYPES)
+                if trade_type_matches[trade_type]:
+                    filtered_rows.append(row)
+                    row_numbers.append(row_count)
 
         if not filtered_rows:
             self.debug_print("No matching trade data found in the CSV", 1)
@@ -130,8 +203,8 @@ class FileProcessor:
         # Create DataFrame with proper headers
         df = pd.DataFrame(filtered_rows, columns=headers)
 
-        # Add symbol component columns
-        symbol_df = pd.DataFrame(parsed_symbols)
+        # Add symbol component columns, parsed for the whole symbol column at once
+        symbol_df = self.parse_symbols(df.iloc[:, 3], df.iloc[:, 2], row_numbers)
 
         # Combine the original data with parsed symbol components
         df = pd.concat([df, symbol_df], axis=1)
@@ -139,6 +212,14 @@ class FileProcessor:
         self.debug_print("Exiting parse_csv()", 1)
         return df, statement_info, account_info
 
+    def extract_statement(self, file):
+        """
+        Parse everything the ingest needs from one raw statement file, so a single task per
+        file can be handed to process_files. Returns (trade data, statement info, account info, NAV values)
+        """
+        df, statement_info, account_info = self.extract_trade_data(file)
+        return df, statement_info, account_info, self.extract_nav_values(file)
+
     def load_prepared_data(self, file):
         '''Load data from a prepared CSV file into a pandas dataframe'''
 
@@ -230,94 +311,72 @@ class FileProcessor:
 
     def parse_symbol(self, symbol, trade_type):
         """
-        Parse symbol based on trade type and return a dictionary of components
+        Parse a single symbol, see parse_symbols
+        Raises:
+            ValueError: If a futures symbol can't be resolved to an underlying
+        """
+        return self.parse_symbols(pd.Series([symbol]), pd.Series([trade_type])).iloc[0].to_dict()
+
+    def parse_symbols(self, symbols, trade_types, row_numbers=None):
+        """
+        Parse a column of symbols based on their trade types into their components
         Args:
-            symbol: The trading symbol
-            trade_type: Type of trade (Stocks, Equity and Index Options, Futures)
+            symbols: Series of trading symbols
+            trade_types: Series of trade types (Stocks, Equity and Index Options, Futures)
+            row_numbers: Statement row number of each symbol, used in error messages
         Returns:
-            Dictionary containing symbol components and underlying
+            DataFrame with original_symbol, trade_type, underlying, expiry, strike and option_type columns
         Raises:
-            ValueError: If a futures symbol is not found in the replacement dictionary
+            ValueError: If any futures symbol can't be resolved to an underlying
         """
-        self.debug_print("Entering parse_symbol()", 1)
-        self.debug_print(f"Processing symbol: {symbol}, trade_type: {trade_type}", 3)
-
-        try:
-            result = {
-                'original_symbol': symbol.lower(),
-                'trade_type': trade_type,
-                'underlying': None,
-                'expiry': None,
-                'strike': None,
-                'option_type': None
-            }
-
-            replacement_dict = {
-                # CL replacements
-                'CLN4': 'cl', 'CLQ4': 'cl', 'MCLN4': 'cl', 'MCLV4': 'cl', 'MCLX4': 'cl', 'MCLZ4': 'cl', 'MCLF5': 'cl',
-                # M2K replacements
-                'M2KM4': 'm2k', 'M2KU4': 'm2k', 'M2KZ4': 'm2k',
-                # MES replacements
-                'MESM4': 'mes', 'M3SU4': 'mes', 'MESZ4': 'mes', 'MESU4': 'mes',
-                # MGC replacements
-                'MGCQ4': 'mgc', 'MGCV4': 'mgc', 'MGCZ4': 'mgc', 'MGCG5': 'mgc',
-                # MHG replacements
-                'MHGQ4': 'mhg', 'MHGV4': 'mhg', 'MHGX4': 'mhg', 'MHGZ4': 'mhg', "MHGN4": 'mhg',
-                # MNQ replacements
-                'MNQM4': 'mnq', 'MNQU4': 'mnq', 'MNQZ4': 'mnq',
-                # MNG replacements
-                'MNGQ4': 'mng', 'MNGV4': 'mng', 'MNGZ4': 'mng', 'MNGN4': 'mng',
-                # Other replacements
-                'QIU4': 'qi',
-                'YMU4': 'ym'
-            }
-
-            if trade_type == 'Stocks':
-                result['underlying'] = symbol.lower()
-                self.debug_print(f"Stock trade - using symbol as underlying: {symbol}", 2)
-
-            elif trade_type == 'Equity and Index Options':
-                components = symbol.split()
-                if len(components) >= 4:
-                    result.update({
-                        'underlying': components[0].lower(),
-                        'expiry': components[1].lower(),
-                        'strike': components[2],
-                        'option_type': components[3].lower()
-                    })
-                    self.debug_print(f"Option components parsed: {result}", 2)
-                else:
-                    self.debug_print(f"Invalid option format: {symbol}", 2)
-                    result['underlying'] = symbol
-
-            elif trade_type == 'Futures':
-                if symbol in replacement_dict:
-                    result['underlying'] = replacement_dict[symbol]
-                    self.debug_print(f"Futures trade - mapped {symbol} to {result['underlying']}", 2)
-                else:
-                    error_msg = f"No mapping found for futures symbol: {symbol}"
-                    self.debug_print(f"Error: {error_msg}", 1)
-                    raise ValueError(error_msg)
-
-            else:
-                result['underlying'] = symbol
-                self.debug_print(f"Unknown trade type: {trade_type}, using original symbol", 2)
-
-            return result
+        self.debug_print("Entering parse_symbols()", 1)
+
+        # Statements repeat the same symbols a lot (one row per lot, total rows...), so each
+        # distinct (symbol, trade type) pair is only parsed once
+        symbol_codes, symbol_values = pd.factorize(symbols.to_numpy())
+        type_codes, type_values = pd.factorize(trade_types.to_numpy())
+        codes, pairs = pd.factorize(symbol_codes * len(type_values) + type_codes)
+        unique_symbols = pd.Series(symbol_values[pairs // len(type_values)], dtype=object)
+        unique_types = pd.Series(type_values[pairs % len(type_values)], dtype=object)
+
+        parsed = pd.DataFrame({'original_symbol': unique_symbols.str.lower(),
+                               'trade_type': unique_types,
+                               'underlying': unique_symbols,
+                               'expiry': None,
+                               'strike': None,
+                               'option_type': None})
+
+        stocks = unique_types == 'Stocks'
+        parsed.loc[stocks, 'underlying'] = unique_symbols[stocks].str.lower()
+
+        # Options are "UNDERLYING EXPIRY STRIKE C/P", anything shorter keeps the symbol as underlying
+        options = unique_symbols[unique_types == 'Equity and Index Options'].str.split()
+        options = options[options.str.len() >= 4]
+        parsed.loc[options.index, ['underlying', 'expiry', 'strike', 'option_type']] = np.column_stack(
+            [options.str[0].str.lower(), options.str[1].str.lower(), options.str[2], options.str[3].str.lower()])
+
+        unresolved = {}
+        for index, symbol in unique_symbols[unique_types == 'Futures'].items():
+            try:
+                parsed.at[index, 'underlying'] = resolve_futures_underlying(symbol)
+            except ValueError as ve:
+                unresolved[index] = str(ve)
+
+        if unresolved:
+            if row_numbers is None:
+                row_numbers = range(len(codes))
+            error_msg = "\n".join(f"Row {row_numbers[row]}: {unresolved[code]}"
+                                  for row, code in enumerate(codes) if code in unresolved)
+            self.debug_print(f"Encountered errors while processing:\n{error_msg}", 1)
+            raise ValueError(f"Failed to process some futures symbols:\n{error_msg}")
 
-        except ValueError as ve:
-            # Re-raise ValueError for futures mapping errors
-            raise
-        except Exception as e:
-            self.debug_print(f"Error processing symbol {symbol}: {str(e)}", 1)
-            return {'original_symbol': symbol, 'underlying': symbol, 'trade_type': trade_type}
-        finally:
-            self.debug_print("Exiting parse_symbol()", 1)
+        self.debug_print(f"Parsed {len(parsed)} distinct symbols for {len(codes)} rows", 2)
+        self.debug_print("Exiting parse_symbols()", 1)
+        return parsed.take(codes).reset_index(drop=True)
 
     def extract_nav_values(self, file):
         """Extract NAV and related values from CSV file"""
         self.debug_print("Entering extract_nav_values()", 1)
-        file_path = os.path.join(self.trades_dir, file)
 
         # Initialize with default values (0.0)
         nav_values = {
@@ -337,47 +396,42 @@ class FileProcessor:
             'other_fee': 0.0
         }
 
-        try:
-            with open(file_path, 'r') as file:
-                for line in file:
-                    row = next(csv.reader([line]))
-                    self.debug_print(f"Processing row: {row}", 3)
-
-                    if len(row) >= 4:  # Ensure row has enough columns
-                        # Handle Change in NAV rows
-                        if row[0] == 'Change in NAV':
-                            field_mapping = {
-                                'Starting Value': 'starting_value',
-                                'Ending Value': 'ending_value',
-                                'Realized P/L': 'realized_pl',
-                                'Change in Unrealized P/L': 'change_in_unrealized_pl',
-                                'Transferred P/L Adjustments': 'transferred_pl_adjustments',
-                                'Deposits & Withdrawals': 'deposits_and_withdrawals',
-                                'Position Transfers': 'position_transfers',
-                                'Dividends': 'dividends',
-                                'Withholding Tax': 'withholding_tax',
-                                'Change in Dividend Accruals': 'dividend_accruals',
-                                'Interest': 'interest',
-                                'Change in Interest Accruals': 'interest_accruals',
-                                'Other Fees': 'other_fee'
-                            }
+        field_mapping = {
+            'Starting Value': 'starting_value',
+            'Ending Value': 'ending_value',
+            'Realized P/L': 'realized_pl',
+            'Change in Unrealized P/L': 'change_in_unrealized_pl',
+            'Transferred P/L Adjustments': 'transferred_pl_adjustments',
+            'Deposits & Withdrawals': 'deposits_and_withdrawals',
+            'Position Transfers': 'position_transfers',
+            'Dividends': 'dividends',
+            'Withholding Tax': 'withholding_tax',
+            'Change in Dividend Accruals': 'dividend_accruals',
+            'Interest': 'interest',
+            'Change in Interest Accruals': 'interest_accruals',
+            'Other Fees': 'other_fee'
+        }
 
-                            if row[2] in field_mapping:
-                                try:
-                                    value = float(row[3].replace(',', '').replace('$', ''))
-                                    nav_values[field_mapping[row[2]]] = value
-                                    self.debug_print(f"Found {field_mapping[row[2]]}: {value}", 2)
-                                except ValueError:
-                                    self.debug_print(f"Could not convert value for {row[2]}: {row[3]}", 2)
-
-                        # Handle Time Weighted Rate of Return
-                        elif row[0] == 'Time Weighted Rate of Return':
-                            try:
-                                value = float(row[3].replace('%', '').replace(',', ''))
-                                nav_values['time_weighted_rr'] = value
-                                self.debug_print(f"Found time_weighted_rr: {value}", 2)
-                            except ValueError:
-                                self.debug_print(f"Could not convert Time Weighted RR: {row[3]}", 2)
+        try:
+            # Handle Change in NAV rows
+            for _, row in self.section_rows(file, 'Change in NAV'):
+                if len(row) >= 4 and row[2] in field_mapping:  # Ensure row has enough columns
+                    try:
+                        value = float(row[3].replace(',', '').replace('$', ''))
+                        nav_values[field_mapping[row[2]]] = value
+                        self.debug_print(f"Found {field_mapping[row[2]]}: {value}", 2)
+                    except ValueError:
+                        self.debug_print(f"Could not convert value for {row[2]}: {row[3]}", 2)
+
+            # Handle Time Weighted Rate of Return
+            for _, row in self.section_rows(file, 'Time Weighted Rate of Return'):
+                if len(row) >= 4:
+                    try:
+                        value = float(row[3].replace('%', '').replace(',', ''))
+                        nav_values['time_weighted_rr'] = value
+                        self.debug_print(f"Found time_weighted_rr: {value}", 2)
+                    except ValueError:
+                        self.debug_print(f"Could not convert Time Weighted RR: {row[3]}", 2)
 
             self.debug_print("NAV values extracted:", 2)
             for key, value in nav_values.items():
@@ -392,9 +446,70 @@ class FileProcessor:
             self.debug_print("Exiting extract_nav_values()", 1)
 
     def get_csv_files(self):
+        """
+        CSV files in the trades directory. With a manifest, only the files that are new or modified
+        since it recorded them, and the state of every file is kept in file_states for recording
+        them once ingested.
+        """
         files = []
         for file in os.listdir(self.trades_dir):
             if file.endswith('.csv') and os.path.isfile(os.path.join(self.trades_dir, file)):
                 files.append(file)
 
-        return files
+        # Sorted so files are always processed in the same order
+        files = sorted(files)
+        if self.manifest is None:
+            return files
+
+        changed = []
+        for file in files:
+            path = os.path.join(self.trades_dir, file)
+            self.file_states[file] = self.manifest.file_state(path)
+            if not self.manifest.is_unchanged(path, self.file_states[file]):
+                changed.append(file)
+
+        self.debug_print(f"{len(files) - len(changed)} of {len(files)} files unchanged since last ingested", 2)
+        return changed
+
+    def process_files(self, method, files=None, workers=1):
+        """
+        Run a per-file method (e.g. 'extract_trade_data', 'extract_nav_values' or
+        'load_prepared_data') on every file, spread over a pool of worker processes.
+        Args:
+            method: Name of the FileProcessor method to run
+            files: Files in the trades directory, all CSV files by default
+            workers: Number of worker processes, 1 processes the files one at a time in this process
+        Returns:
+            (results, errors): results is a list of (file, result) in the order of files, and errors
+            a list of (file, message) for the files that failed, which don't stop the others
+        """
+        self.debug_print("Entering process_files()", 1)
+        if files is None:
+            files = self.get_csv_files()
+
+        results = []
+        errors = []
+
+        if workers <= 1 or len(files) <= 1:
+            for file in files:
+                try:
+                    results.append((file, getattr(self, method)(file)))
+                except Exception as e:
+                    errors.append((file, str(e)))
+        else:
+            # Spawned rather than forked: this can run on an executor thread of the server, and
+            # forking a threaded process can leave the children holding locks nobody releases
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = [executor.submit(run_file_method, self.trades_dir, self.debug_level, method, file)
+                           for file in files]
+                for file, future in zip(files, futures):
+                    try:
+                        results.append((file, future.result()))
+                    except Exception as e:
+                        errors.append((file, str(e)))
+
+        for file, message in errors:
+            self.debug_print(f"Error processing {file}: {message}", 1)
+
+        self.debug_print("Exiting process_files()", 1)
+        return results, errors
@@ -0,0 +1,124 @@
+'''
+Manifest of the statement files already ingested, so a refresh only reads the files that are
+new or modified since (see FileProcessor.get_csv_files).
+
+Each file is recorded with its size, modification time and content hash, along with the key and a
+hash of every statement it produced. A file whose size and mtime match its entry is taken as
+unchanged without reading it, otherwise its content hash decides. Only files whose statements are
+all still in the database count as recorded, see drop_missing.
+
+The statements of a file are stored as one tab-separated line per statement in a single string,
+and only decoded when a file is re-read or the database changed, which keeps loading the manifest
+cheap however long the history.
+'''
+import hashlib
+import json
+import os
+
+# Kept next to database.db, see the datasource in schema.prisma
+MANIFEST_FILE = 'database.manifest.json'
+MANIFEST_VERSION = 2
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def encode_statements(statements):
+    return ''.join(f'{start}\t{end}\t{account}\t{statement_hash}\n'
+                   for (start, end, account), statement_hash in statements.items())
+
+
+def decode_statements(lines):
+    statements = {}
+    for line in lines.splitlines():
+        start, end, account, statement_hash = line.split('\t')
+        statements[(start, end, account)] = statement_hash
+    return statements
+
+
+class IngestManifest:
+    """
+    files      {absolute path: {size, mtime_ns, sha256, statements}} of the ingested files
+    database   get_statement_signature of the database when the manifest was saved
+    """
+
+    def __init__(self, path=MANIFEST_FILE, files=None, database=None):
+        self.path = path
+        self.files = files if files is not None else {}
+        self.database = database
+        self.modified = False
+
+    @classmethod
+    def load(cls, path=MANIFEST_FILE):
+        """The manifest at path, or an empty one if there is none or it can't be read"""
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                return cls(path, manifest['files'], manifest['database'])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable ingest manifest {path}: {e}")
+        return cls(path)
+
+    def save(self, database):
+        """Write the manifest, describing the database with signature database, if anything changed"""
+        if database != self.database:
+            self.database = database
+            self.modified = True
+        if not self.modified:
+            return
+
+        # Written to a temporary file first, so an interrupted save never leaves a partial manifest
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'database': self.database, 'files': self.files}, f)
+        os.replace(temporary, self.path)
+        self.modified = False
+
+    def file_state(self, path):
+        """
+        (size, mtime_ns, sha256) of the file at path, hashing it only when its size or mtime differ
+        from its entry. The stat is taken before the hash, so a file modified while it is read is
+        seen as modified again next time rather than recorded with contents that weren't ingested.
+        """
+        stat = os.stat(path)
+        entry = self.files.get(os.path.abspath(path))
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['size'], entry['mtime_ns'], entry['sha256']
+        return stat.st_size, stat.st_mtime_ns, file_hash(path)
+
+    def is_unchanged(self, path, state):
+        """Whether the file at path, in state (see file_state), has the contents it was recorded with"""
+        entry = self.files.get(os.path.abspath(path))
+        if entry is None or entry['sha256'] != state[2]:
+            return False
+        if entry['mtime_ns'] != state[1]:
+            # Touched but not modified, keep the new mtime so it isn't hashed again
+            entry['mtime_ns'] = state[1]
+            self.modified = True
+        return True
+
+    def statement_hashes(self, path):
+        """{statement key: statement hash} of the statements the file produced when it was recorded"""
+        entry = self.files.get(os.path.abspath(path))
+        if entry is None:
+            return {}
+        return decode_statements(entry['statements'])
+
+    def record(self, path, state, statements):
+        """Record the file at path as ingested in state (see file_state), producing {statement key: hash}"""
+        size, mtime_ns, sha256 = state
+        self.files[os.path.abspath(path)] = {'size': size, 'mtime_ns': mtime_ns, 'sha256': sha256,
+                                             'statements': encode_statements(statements)}
+        self.modified = True
+
+    def drop_missing(self, existing):
+        """Forget the files with statements no longer in the database (existing keys), so they are read again"""
+        for path, entry in list(self.files.items()):
+            if any(key not in existing for key in decode_statements(entry['statements'])):
+                del self.files[path]
+                self.modified = True
@@ -0,0 +1,219 @@
+'''
+On-disk snapshot of the dataframes built by DataframeLoader, so the server can start
+without rebuilding them from the database when nothing has changed.
+
+The statement table the three dataframes share is stored once: its numeric columns as a float
+matrix (.npy, memory-mapped on load), with the dates, account names and the column order kept in
+metadata.json. Each dataframe then only adds its totals and its matrix of security values, or the
+arrays of its SparseSecurities store when loaded with the sparse security store.
+The arrays of the AggregateCube are stored the same way. metadata.json is written last and
+replaced atomically, so a snapshot is either complete or ignored.
+
+Because the matrices are memory-mapped read-only, every worker process of a multi-worker server
+(see Core/workers.py) that loads the same snapshot shares one copy of them through the page cache.
+'''
+from Utils.DataframeLoader import (PNL_TYPES, PNL_RELATIONS, STATEMENT_DATE_COLUMNS, assemble_dataframes,
+                                   compact_statements, statement_table)
+from Utils.dataframeprocessor import get_security_columns, get_security_store
+from Utils.sparsestore import SparseSecurities
+from Utils import DataframeLoader
+from Utils.aggregatecube import AggregateCube
+import numpy as np
+import pandas as pd
+import json
+import os
+import uuid
+
+SNAPSHOT_DIR = 'snapshot'
+
+# Bump whenever the layout of the snapshot changes so older snapshots are rebuilt
+SNAPSHOT_VERSION = 5
+
+METADATA_FILE = 'metadata.json'
+
+
+def write_snapshot(dataframes, signature, directory=SNAPSHOT_DIR):
+    """
+    Save the dataframes to disk, tagged with the database signature they were loaded from
+    """
+    try:
+        os.makedirs(directory, exist_ok=True)
+        generation = uuid.uuid4().hex
+        metadata = {'version': SNAPSHOT_VERSION,
+                    'signature': signature,
+                    'generation': generation,
+                    'security_store': DataframeLoader.SECURITY_STORE,
+                    'frames': {}}
+
+        for pnl_type in PNL_TYPES:
+            dataframe = dataframes[pnl_type]
+            if dataframe.empty:
+                continue
+
+            total_file = f"{pnl_type}-total-{generation}.npy"
+            np.save(os.path.join(directory, total_file), dataframe[PNL_RELATIONS[pnl_type]].to_numpy())
+            metadata['frames'][pnl_type] = {'total': total_file}
+
+            store = get_security_store(dataframe)
+            if store is not None:
+                metadata['frames'][pnl_type]['symbols'] = store.symbols
+                for name in ('indptr', 'indices', 'data'):
+                    metadata['frames'][pnl_type][name] = f"{pnl_type}-{name}-{generation}.npy"
+                    np.save(os.path.join(directory, metadata['frames'][pnl_type][name]), getattr(store, name))
+                continue
+
+            # Store the matrix column-major so it maps straight onto a pandas float block
+            securities = get_security_columns(dataframe)
+            matrix_file = f"{pnl_type}-{generation}.npy"
+            np.save(os.path.join(directory, matrix_file), np.ascontiguousarray(dataframe[securities].to_numpy().T))
+            metadata['frames'][pnl_type].update({'matrix': matrix_file, 'matrix_columns': securities})
+
+        if not dataframes['total'].empty:
+            metadata['statements'] = write_statements(statement_table(dataframes['total']), directory, generation)
+
+        metadata['cube'] = write_cube(dataframes['cube'], directory, generation)
+
+        temp_file = os.path.join(directory, f"{METADATA_FILE}.{generation}")
+        with open(temp_file, 'w') as file:
+            json.dump(metadata, file)
+        os.replace(temp_file, os.path.join(directory, METADATA_FILE))
+
+        remove_stale_files(directory, generation)
+    except Exception as e:
+        print(f"Something went wrong while writing dataframe snapshot: {e}")
+
+
+def load_snapshot(signature, directory=SNAPSHOT_DIR):
+    """
+    Load the dataframes from disk if the snapshot matches the current version and database
+    signature, or any signature when signature is None. Returns None when there is no usable snapshot.
+    """
+    try:
+        metadata_path = os.path.join(directory, METADATA_FILE)
+        if not os.path.exists(metadata_path):
+            return None
+
+        with open(metadata_path) as file:
+            metadata = json.load(file)
+
+        if metadata['version'] != SNAPSHOT_VERSION or signature not in (None, metadata['signature']):
+            return None
+
+        # Written with the other security store, rebuild rather than convert it
+        if metadata['security_store'] != DataframeLoader.SECURITY_STORE:
+            return None
+
+        if metadata.get('statements') is None:
+            dataframes = {pnl_type: pd.DataFrame() for pnl_type in PNL_TYPES}
+        else:
+            totals = {}
+            securities = {}
+            for pnl_type in PNL_TYPES:
+                frame_data = metadata['frames'][pnl_type]
+                totals[pnl_type] = np.load(os.path.join(directory, frame_data['total']))
+                if 'symbols' in frame_data:
+                    arrays = {name: np.load(os.path.join(directory, frame_data[name]), mmap_mode='r')
+                              for name in ('indptr', 'indices', 'data')}
+                    securities[pnl_type] = SparseSecurities(frame_data['symbols'], **arrays)
+                    continue
+
+                matrix = np.load(os.path.join(directory, frame_data['matrix']), mmap_mode='r')
+                securities[pnl_type] = pd.DataFrame(matrix.T, columns=pd.Index(frame_data['matrix_columns'], dtype=object),
+                                                    copy=False)
+
+            # Saved already sorted, so the memory-mapped matrices are used as they are
+            dataframes = assemble_dataframes(load_statements(metadata['statements'], directory), totals, securities)
+
+        dataframes['cube'] = load_cube(metadata['cube'], directory)
+        return dataframes
+    except Exception as e:
+        print(f"Something went wrong while loading dataframe snapshot, ignoring it: {e}")
+        return None
+
+
+def snapshot_stamp(directory=SNAPSHOT_DIR):
+    """
+    (inode, modification time) of metadata.json, which changes every time a snapshot is written,
+    or None if there is no snapshot. Much cheaper than reading the metadata to check for a new one.
+    """
+    try:
+        stat = os.stat(os.path.join(directory, METADATA_FILE))
+        return stat.st_ino, stat.st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def write_statements(statement_df, directory, generation):
+    """Save the shared statement table and return the metadata needed to load it"""
+    numeric = statement_df.select_dtypes(include='float64')
+    other = statement_df.drop(columns=numeric.columns)
+
+    matrix_file = f"statements-{generation}.npy"
+    np.save(os.path.join(directory, matrix_file), np.ascontiguousarray(numeric.to_numpy().T))
+
+    other_columns = {column: other[column].astype(str).tolist() for column in other.columns}
+    for column in STATEMENT_DATE_COLUMNS:
+        other_columns[column] = other[column].dt.strftime('%Y-%m-%d').tolist()
+
+    return {'columns': statement_df.columns.tolist(),
+            'matrix': matrix_file,
+            'matrix_columns': numeric.columns.tolist(),
+            'other_columns': other_columns}
+
+
+def load_statements(statement_data, directory):
+    matrix = np.load(os.path.join(directory, statement_data['matrix']), mmap_mode='r')
+    statement_df = pd.DataFrame(matrix.T, columns=pd.Index(statement_data['matrix_columns'], dtype=object), copy=False)
+
+    columns = statement_data['columns']
+    for column, values in statement_data['other_columns'].items():
+        statement_df.insert(loc=columns.index(column), column=column, value=values)
+
+    return compact_statements(statement_df)
+
+
+def write_cube(cube: AggregateCube, directory, generation):
+    """Save the arrays of an AggregateCube and return the metadata needed to load it"""
+    arrays = {'present': cube.present, 'metrics': cube.metrics}
+    for pnl_type, values in cube.securities.items():
+        if isinstance(values, SparseSecurities):
+            arrays.update({f"securities-{pnl_type}-{name}": getattr(values, name) for name in ('indptr', 'indices', 'data')})
+        else:
+            arrays[f"securities-{pnl_type}"] = values
+
+    files = {}
+    for name, values in arrays.items():
+        files[name] = f"cube-{name}-{generation}.npy"
+        np.save(os.path.join(directory, files[name]), values)
+
+    return {'dates': np.datetime_as_string(cube.dates).tolist(),
+            'accounts': cube.accounts,
+            'symbols': cube.symbols,
+            'files': files}
+
+
+def load_cube(cube_data, directory):
+    files = cube_data['files']
+    arrays = {name: np.load(os.path.join(directory, file), mmap_mode='r') for name, file in files.items()}
+
+    securities = {}
+    for pnl_type, symbols in cube_data['symbols'].items():
+        if f"securities-{pnl_type}" in arrays:
+            securities[pnl_type] = arrays[f"securities-{pnl_type}"]
+        else:
+            securities[pnl_type] = SparseSecurities(symbols, *(arrays[f"securities-{pnl_type}-{name}"]
+                                                               for name in ('indptr', 'indices', 'data')))
+
+    return AggregateCube(dates=np.array(cube_data['dates'], dtype='datetime64[D]'),
+                         accounts=cube_data['accounts'],
+                         present=arrays['present'],
+                         metrics=arrays['metrics'],
+                         symbols=cube_data['symbols'],
+                         securities=securities)
+
+
+def remove_stale_files(directory, generation):
+    """Delete matrices left behind by previous snapshots"""
+    for file in os.listdir(directory):
+        if file.endswith('.npy') and generation not in file:
+            os.remove(os.path.join(directory, file))
@@ -0,0 +1,123 @@
+'''
+Sparse storage of the security values of a loaded dataframe, used instead of one wide column per
+symbol when DataframeLoader.SECURITY_STORE is 'sparse'.
+
+A statement only holds a small share of every symbol ever traded, so the wide layout is mostly NaN
+and grows with rows x symbols. Here the values are kept in compressed sparse row (CSR) form: the
+values of statement row i are data[indptr[i]:indptr[i + 1]], for the symbols whose codes in the
+symbols dictionary are indices[indptr[i]:indptr[i + 1]]. Memory scales with the values actually held.
+'''
+import numpy as np
+
+
+class SparseSecurities:
+    """
+    (statement row x symbol) security values of one P&L type in CSR form, see the module docstring.
+    Missing values are simply not stored, and count as 0 when summed like NaN does in the wide layout.
+    Never modified once built.
+    """
+
+    def __init__(self, symbols, indptr, indices, data):
+        self.symbols = symbols
+        self.symbol_index = {symbol: i for i, symbol in enumerate(symbols)}
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    def __deepcopy__(self, memo):
+        # Carried in the attrs of the dataframes, which pandas deep copies into every selection.
+        # Nothing modifies a store, so all of them can share it.
+        return self
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    @classmethod
+    def from_triples(cls, symbols, length, rows, codes, values, dtype=np.float64):
+        """Build a store of length rows from (row, symbol code, value) triples with unique (row, code) pairs"""
+        order = np.lexsort((codes, rows))
+        indptr = np.zeros(length + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=length), out=indptr[1:])
+        return cls(symbols, indptr, codes[order].astype(np.int32), values[order].astype(dtype))
+
+    @classmethod
+    def from_sums(cls, symbols, length, rows, codes, values, dtype=np.float64):
+        """Build a store of length rows from (row, symbol code, value) triples, summing those with the same (row, code)"""
+        width = max(len(symbols), 1)
+        keys, inverse = np.unique(np.asarray(rows, dtype=np.int64) * width + codes, return_inverse=True)
+        sums = np.bincount(inverse, weights=values, minlength=len(keys))
+        return cls.from_triples(symbols, length, keys // width, keys % width, sums, dtype)
+
+    @classmethod
+    def concat(cls, stores):
+        """Stack stores row-wise. Symbols keep the order of the first store they appear in."""
+        symbol_index = {}
+        indptrs = [np.zeros(1, dtype=np.int64)]
+        indices = []
+        offset = 0
+        for store in stores:
+            codes = np.array([symbol_index.setdefault(symbol, len(symbol_index)) for symbol in store.symbols],
+                             dtype=np.int32)
+            indices.append(codes[store.indices])
+            indptrs.append(store.indptr[1:] + offset)
+            offset += store.indptr[-1]
+
+        return cls(list(symbol_index), np.concatenate(indptrs), np.concatenate(indices),
+                   np.concatenate([store.data for store in stores]))
+
+    def positions(self, rows):
+        """Positions in indices and data of the values of rows, row after row"""
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        # Each row's run of positions is its start plus a running count, less the values before it
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return offsets + np.arange(lengths.sum())
+
+    def take(self, rows):
+        """New store holding rows, in that order"""
+        rows = np.asarray(rows, dtype=np.int64)
+        positions = self.positions(rows)
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(self.indptr[rows + 1] - self.indptr[rows], out=indptr[1:])
+        return SparseSecurities(self.symbols, indptr, self.indices[positions], self.data[positions])
+
+    def column_sums(self, rows):
+        """Value of every symbol summed over rows, in symbol order"""
+        positions = self.positions(rows)
+        return np.bincount(self.indices[positions], weights=self.data[positions], minlength=len(self.symbols))
+
+    def to_dense(self, rows, symbols):
+        """(rows x symbols) matrix of the values of some symbols, NaN where there is none"""
+        codes = np.full(len(self.symbols), -1, dtype=np.int64)
+        for i, symbol in enumerate(symbols):
+            if symbol not in self.symbol_index:
+                raise KeyError(f"{symbol!r} not in the securities")
+            codes[self.symbol_index[symbol]] = i
+
+        rows = np.asarray(rows, dtype=np.int64)
+        positions = self.positions(rows)
+        row_numbers = np.repeat(np.arange(len(rows)), self.indptr[rows + 1] - self.indptr[rows])
+        columns = codes[self.indices[positions]]
+        wanted = columns >= 0
+
+        matrix = np.full((len(rows), len(symbols)), np.nan)
+        matrix[row_numbers[wanted], columns[wanted]] = self.data[positions][wanted]
+        return matrix
+
+    def row_numbers(self):
+        """Row of every stored value, in storage order"""
+        return np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+    def group_sums(self, starts):
+        """
+        New store with one row per run of consecutive rows, the runs starting at rows starts,
+        holding the sums of their values, like np.add.reduceat over the rows of the dense matrix
+        with missing values as 0
+        """
+        groups = np.searchsorted(starts, self.row_numbers(), side='right') - 1
+        return SparseSecurities.from_sums(self.symbols, len(starts), groups, self.indices, self.data, self.data.dtype)
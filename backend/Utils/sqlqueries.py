@@ -0,0 +1,253 @@
+'''
+Query backend answering the dashboard queries with aggregate SQL against the SQLite database,
+for histories too large to hold in memory (python main.py --query-backend sql).
+
+SqlQueries has the query methods of AggregateCube and returns the same results, but the account
+and date filters and the sums run in SQLite, so only result rows are read into Python. Statement
+dates are compared as the YYYY-MM-DD strings they are stored as. The connections are read-only and
+opened per thread, since the route handlers run in FastAPI's threadpool.
+'''
+from Utils.DataframeLoader import PNL_RELATIONS
+from Utils.db import CONNECTION_PRAGMAS, TOTAL_TABLES
+from Utils.dataframeprocessor import normalize_date, rank_securities
+import numpy as np
+import sqlite3
+import threading
+
+# The database the Prisma client writes to, see the datasource in schema.prisma
+DATABASE_FILE = 'database.db'
+
+# Missing values count as 0 in every metric but dividends, as in aggregatecube.statement_metrics
+CARD_QUERY = '''
+SELECT COUNT(*) AS statements,
+       TOTAL(ending_value - transferred_pl_adjustments - deposits_and_withdrawals + dividends
+             - starting_value + dividend_accruals - interest - interest_accruals + other_fee) AS total_gains,
+       TOTAL(realized_pl) AS realized_gains,
+       TOTAL(change_in_unrealized_pl) AS unrealized_gains,
+       TOTAL(interest) AS interest,
+       CASE WHEN COUNT(dividends + dividend_accruals) = COUNT(*)
+            THEN SUM(dividends + dividend_accruals) END AS dividends
+FROM Statement
+WHERE statement_end = ? AND account_name IN ({accounts})
+'''
+
+SECURITY_TOTALS_QUERY = '''
+SELECT Security.symbol, TOTAL(Security.value) AS value
+FROM Statement
+JOIN {table} AS parent ON parent.statement_id = Statement.id
+JOIN Security ON Security.{foreign_key} = parent.id
+WHERE Statement.statement_end = ? AND Statement.account_name IN ({accounts})
+GROUP BY Security.symbol
+'''
+
+SERIES_DATES_QUERY = '''
+SELECT DISTINCT statement_end
+FROM Statement
+WHERE statement_end BETWEEN ? AND ? AND account_name IN ({accounts})
+ORDER BY statement_end
+'''
+
+# Driven from the symbols rather than the date range (the unary + keeps SQLite off the
+# statement_end index), so the cost is bounded by the history of the few securities asked for
+SERIES_QUERY = '''
+SELECT Statement.statement_end, Security.symbol, TOTAL(Security.value) AS value
+FROM Statement
+JOIN {table} AS parent ON parent.statement_id = Statement.id
+JOIN Security ON Security.{foreign_key} = parent.id
+WHERE +Statement.statement_end BETWEEN ? AND ? AND Statement.account_name IN ({accounts})
+  AND Security.symbol IN ({symbols})
+GROUP BY Statement.statement_end, Security.symbol
+'''
+
+# In the order the loaded dataframes hold them: accounts by their first statement date,
+# symbols by the first statement they appear in, then alphabetically. One scan of Security is
+# cheaper than walking the symbol index when every row is read anyway.
+ACCOUNTS_QUERY = '''
+SELECT account_name
+FROM Statement
+GROUP BY account_name
+ORDER BY MIN(statement_end), account_name
+'''
+
+SYMBOLS_QUERY = '''
+SELECT Security.symbol
+FROM Security NOT INDEXED
+JOIN {table} AS parent ON parent.id = Security.{foreign_key}
+JOIN Statement ON Statement.id = parent.statement_id
+GROUP BY Security.symbol
+ORDER BY MIN(Statement.rowid), Security.symbol
+'''
+
+
+def placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+def sql_dataframes(path=DATABASE_FILE):
+    """Stand-in for the loaded dataframes that Core.server publishes, all answered by one SqlQueries"""
+    queries = SqlQueries(path)
+    return {'total': queries, 'cube': queries}
+
+
+class SqlQueries:
+    """
+    Dashboard queries against the database at path, with the same methods and results as
+    AggregateCube. The symbols of each P&L type are read once and kept, so a new instance
+    should be published whenever statements are added.
+    """
+
+    def __init__(self, path=DATABASE_FILE):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.symbols = {}
+        self.accounts = None
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+            for pragma in CONNECTION_PRAGMAS:
+                connection.execute(pragma)
+            self.local.connection = connection
+        return connection
+
+    def query(self, sql, parameters=()):
+        return self.connection().execute(sql, parameters).fetchall()
+
+    def get_symbols(self, pnl_type):
+        """Symbols of a P&L type, in the column order of the loaded dataframe"""
+        with self.lock:
+            if pnl_type not in self.symbols:
+                table, foreign_key = TOTAL_TABLES[PNL_RELATIONS[pnl_type]]
+                rows = self.query(SYMBOLS_QUERY.format(table=table, foreign_key=foreign_key))
+                symbols = [symbol for symbol, in rows]
+                self.symbols[pnl_type] = (symbols, {symbol: i for i, symbol in enumerate(symbols)})
+            return self.symbols[pnl_type]
+
+    def get_available_accounts(self):
+        with self.lock:
+            if self.accounts is None:
+                self.accounts = [account for account, in self.query(ACCOUNTS_QUERY)]
+            return self.accounts
+
+    def get_available_securities(self):
+        return self.get_symbols('total')[0]
+
+    def card_values(self, accounts, end_date):
+        end = normalize_date(end_date)
+        row = self.query(CARD_QUERY.format(accounts=placeholders(accounts)), [end, *accounts])[0]
+        if not row[0]:
+            raise Exception(f"No data found for account(s) {accounts} on date {end}")
+
+        return {"total_gains": row[1],
+                "realized_gains": row[2],
+                "unrealized_gains": row[3],
+                "interest": row[4],
+                "dividends": np.nan if row[5] is None else row[5]}
+
+    def security_totals(self, pnl_type, accounts, end_date):
+        """Value of every security summed across the accounts on end_date, in symbol order"""
+        symbols, symbol_index = self.get_symbols(pnl_type)
+        table, foreign_key = TOTAL_TABLES[PNL_RELATIONS[pnl_type]]
+        rows = self.query(SECURITY_TOTALS_QUERY.format(table=table, foreign_key=foreign_key,
+                                                       accounts=placeholders(accounts)),
+                          [normalize_date(end_date), *accounts])
+
+        totals = np.zeros(len(symbols))
+        for symbol, value in rows:
+            totals[symbol_index[symbol]] = value
+        return totals
+
+    def security_values(self, pnl_types, accounts, start_date, end_date, securities):
+        """
+        Values of the securities for each P&L type from start_date to end_date, sharing one date axis:
+        {"date": [...], "series": {pnl_type: {security: [...]}}}
+        """
+        start, end = normalize_date(start_date), normalize_date(end_date)
+        dates = [date for date, in self.query(SERIES_DATES_QUERY.format(accounts=placeholders(accounts)),
+                                              [start, end, *accounts])]
+        if not dates:
+            raise Exception(f"No data found for account(s) {accounts} from {start} to {end}")
+        date_index = {date: i for i, date in enumerate(dates)}
+
+        series = {}
+        for pnl_type in pnl_types:
+            symbol_index = self.get_symbols(pnl_type)[1]
+            for security in securities:
+                if security not in symbol_index:
+                    raise KeyError(security)
+
+            table, foreign_key = TOTAL_TABLES[PNL_RELATIONS[pnl_type]]
+            rows = self.query(SERIES_QUERY.format(table=table, foreign_key=foreign_key,
+                                                  accounts=placeholders(accounts),
+                                                  symbols=placeholders(securities)),
+                              [start, end, *accounts, *securities])
+
+            columns = {security: i for i, security in enumerate(securities)}
+            values = np.zeros((len(dates), len(securities)))
+            for date, symbol, value in rows:
+                values[date_index[date], columns[symbol]] = value
+            series[pnl_type] = {security: values[:, i].tolist() for i, security in enumerate(securities)}
+
+        return {"date": dates, "series": series}
+
+    def graph_values(self, pnl_type, accounts, start_date, end_date, security):
+        results = self.security_values([pnl_type], accounts, start_date, end_date, [security])
+        return {"date": results["date"], "value": results["series"][pnl_type][security]}
+
+    def get_card_values(self, accounts, end_date):
+        """Same results as AggregateCube.get_card_values"""
+        try:
+            return self.card_values(accounts, end_date)
+        except Exception as e:
+            print(f"Something went wrong while getting card values: {e}")
+            raise e
+
+    def get_top_bottom(self, pnl_type, accounts, end_date, limit=None):
+        """Same results as AggregateCube.get_top_bottom"""
+        try:
+            totals = self.security_totals(pnl_type, accounts, end_date)
+            return rank_securities(self.get_symbols(pnl_type)[0], totals, limit)
+        except Exception as e:
+            print(f"Something went wrong while getting top-down and bottom-up stocks: {e}")
+            raise e
+
+    def get_security_values(self, pnl_type, accounts, start_date, end_date, security):
+        """Same results as AggregateCube.get_security_values"""
+        try:
+            return self.graph_values(pnl_type, accounts, start_date, end_date, security.upper())
+
+        except Exception as e:
+            print(f"Something went wrong while getting values for {security} from {start_date} to {end_date}: {e}")
+            raise e
+
+    def get_security_series(self, pnl_types, accounts, start_date, end_date, securities):
+        """Same results as AggregateCube.get_security_series"""
+        try:
+            securities = list(dict.fromkeys(security.upper() for security in securities))
+            return self.security_values(pnl_types, accounts, start_date, end_date, securities)
+
+        except Exception as e:
+            print(f"Something went wrong while getting values for {securities} from {start_date} to {end_date}: {e}")
+            raise e
+
+    def get_dashboard(self, sections, pnl_type, accounts, start_date, end_date, security, limit=None):
+        """Same results as AggregateCube.get_dashboard"""
+        queries = {
+            'card_data': lambda: self.card_values(accounts, end_date),
+            'graph_data': lambda: self.graph_values(pnl_type, accounts, start_date, end_date, security.upper()),
+            'top_down_bottom_up': lambda: rank_securities(self.get_symbols(pnl_type)[0],
+                                                          self.security_totals(pnl_type, accounts, end_date), limit),
+        }
+
+        results = {'errors': {}}
+        for section in sections:
+            try:
+                results[section] = queries[section]()
+            except Exception as e:
+                print(f"Something went wrong while getting the {section} dashboard section: {e}")
+                results[section] = None
+                results['errors'][section] = str(e)
+
+        return results
@@ -3,50 +3,132 @@ To run the server:
     1. ensure you have a virtual environment activated
     2. run the command: pip install -r requirements.txt
     3. run the command: python main.py
+
+To serve with several worker processes sharing one copy of the dataframes:
+    python main.py --workers 4
+
+To answer queries with SQL against the database instead of holding the dataframes in memory:
+    python main.py --query-backend sql
 '''
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from Utils.DataframeLoader import load_dataframes
-from Core.middleware import format_filters
-from Core.server import router
+from Utils.snapshot import load_snapshot, write_snapshot
+from Utils.db import get_database_signature, close_db
+from Utils.sqlqueries import sql_dataframes
+from Core.server import router, publish_dataframes, snapshot_watcher
+import argparse
 import asyncio
 import uvicorn
 import sys
 
-async def main():
+HOST = "0.0.0.0"
+PORT = 8000
+# 'memory' serves from the loaded dataframes, 'sql' queries the database for every request
+QUERY_BACKEND = "memory"
+
+async def get_dataframes():
+    """
+    Use the on-disk snapshot when it was taken from the current database contents,
+    otherwise rebuild the dataframes from the database and refresh the snapshot.
+    """
+    signature = await get_database_signature()
+
+    dataframes = load_snapshot(signature)
+    if dataframes is not None:
+        print("Loaded dataframes from snapshot")
+        return dataframes
+
+    dataframes = await load_dataframes()
+    if dataframes is not None:
+        write_snapshot(dataframes, signature)
+    return dataframes
+
+def create_app(lifespan=None):
+    app = FastAPI(lifespan=lifespan)
+
+    origins = ["http://localhost", "http://localhost:3000"]
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["ETag"],
+    )
+
+    app.include_router(router)
+    return app
+
+@asynccontextmanager
+async def attach_snapshot(app):
+    """Lifespan of a worker process: serve from the shared snapshot and follow its new generations"""
+    await snapshot_watcher.start()
+    yield
+    await snapshot_watcher.stop()
+
+def create_worker_app():
+    """App factory uvicorn calls in each worker process"""
+    return create_app(lifespan=attach_snapshot)
+
+async def prepare_snapshot():
+    """Make sure the snapshot on disk is up to date before any worker attaches to it"""
+    try:
+        if await get_dataframes() is None:
+            return False
+        signature = await get_database_signature()
+        return load_snapshot(signature) is not None
+    finally:
+        await close_db()
+
+async def main(query_backend=QUERY_BACKEND):
 
     try:
 
-        # Load dataframes from the database
-        dataframes = await load_dataframes()
-        router.dataframes = dataframes
+        if query_backend == "sql":
+            publish_dataframes(sql_dataframes())
+        else:
+            # Load dataframes from the snapshot or the database
+            dataframes = await get_dataframes()
+            publish_dataframes(dataframes)
 
         # Run the FastAPI application
-        app = FastAPI()
-
-        origins = ["http://localhost", "http://localhost:3000"]
-
-        app.add_middleware(
-            CORSMiddleware,
-            allow_origins=origins,
-            allow_credentials=True,
-            allow_methods=["*"],
-            allow_headers=["*"],
-        )
-        app.middleware('http')(format_filters)
-	
-        app.include_router(router)
-        config = uvicorn.Config(app, host="0.0.0.0", port=8000)
+        app = create_app()
+        config = uvicorn.Config(app, host=HOST, port=PORT)
         server = uvicorn.Server(config)
         await server.serve()
     except Exception as e: 
         print(f"Something went wrong while initializing the server: {e}")
+
+def serve_workers(workers):
+    try:
+        if not asyncio.run(prepare_snapshot()):
+            print("Could not write the dataframe snapshot the workers load from")
+            return
+
+        uvicorn.run("main:create_worker_app", factory=True, host=HOST, port=PORT, workers=workers)
+    except Exception as e:
+        print(f"Something went wrong while initializing the server workers: {e}")
  
 
 if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help="number of worker processes, sharing the dataframes through the snapshot")
+    arg_parser.add_argument('--query-backend', choices=["memory", "sql"], default=QUERY_BACKEND,
+                            help="serve from the loaded dataframes or query the database directly")
+    args = arg_parser.parse_args()
+    if args.workers > 1 and args.query_backend == "sql":
+        arg_parser.error("--workers shares the dataframe snapshot, the sql backend runs in a single process")
+
     try:
-        asyncio.run(main())
+        if args.workers > 1:
+            serve_workers(args.workers)
+        else:
+            asyncio.run(main(args.query_backend))
     except KeyboardInterrupt:
         # Handle graceful shutdown
         asyncio.run(sys.exit(0))